@@ -0,0 +1,311 @@
+"""
+Local stand-in for the public Langfuse API (/api/public/traces, /traces/{id}, /observations and /scores), for benchmarks.
+
+It pages like Langfuse ('page' and 'limit' parameters, at most 100 rows per page, 'meta' with 'totalItems'
+and 'totalPages'), answers 429 with a 'Retry-After' header above the configured request rate, and serves
+synthetic data generated from the row index, so any volume can be served without holding it in memory.
+The time filters are accepted but ignored, every request sees the whole synthetic data set.
+
+Run it standalone and point the pipeline to it with LANGFUSE_BASE_URL:
+    python -m benchmarks.fake_langfuse --traces 10000 --latency-ms 50
+    LANGFUSE_BASE_URL=http://127.0.0.1:8765/api/public ...
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MAX_LIMIT = 100
+_WORDS = ("booking", "guest", "property", "arrival", "payment", "refund", "calendar", "message", "rate", "night")
+
+
+@dataclass
+class FakeConfig:
+    traces: int = 1000
+    observations_per_trace: int = 5
+    scores_per_trace: int = 1
+    # characters of every generated input/output, the system prompt is the same in every observation
+    payload_size: int = 1000
+    # added to every response, with up to the same amount of random jitter
+    latency_ms: float = 0
+    # share of the requests answered with a 500
+    error_rate: float = 0
+    # requests per second above which 429 is returned, 0 for no limit
+    rate_limit: float = 0
+    retry_after_seconds: int = 1
+    seed: int = 0
+
+
+class FakeLangfuse:
+    """
+    Generates the synthetic traces, observations and scores, and counts the requests per endpoint and status.
+    """
+
+    def __init__(self, config: FakeConfig) -> None:
+        self.config = config
+        self.start_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.system_prompt = self._text(config.payload_size, random.Random(config.seed))
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self._window_start = 0.0
+        self._window_requests = 0
+        self._lock = threading.Lock()
+
+    def _text(self, size: int, rng: random.Random) -> str:
+        words = []
+        length = 0
+        while length < size:
+            word = rng.choice(_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)[:size]
+
+    def _timestamp(self, seconds: float) -> str:
+        return (self.start_time + timedelta(seconds=seconds)).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def trace(self, index: int) -> dict:
+        rng = random.Random(self.config.seed * 1_000_003 + index)
+        return {
+            "id": f"trace-{index:010d}",
+            "timestamp": self._timestamp(index),
+            "name": rng.choice(("chat", "search", "summarize")),
+            "input": {"question": self._text(self.config.payload_size // 2, rng)},
+            "output": {"answer": self._text(self.config.payload_size // 2, rng)},
+            "sessionId": f"session-{index // 10}",
+            "release": "v1",
+            "version": None,
+            "userId": f"user-{index % 500}",
+            "metadata": {"channel": rng.choice(("email", "chat"))},
+            "tags": ["benchmark"],
+            "public": False,
+            "htmlPath": f"/project/benchmark/traces/trace-{index:010d}",
+            "totalCost": round(rng.random() / 100, 6),
+            "latency": round(rng.random() * 5, 3),
+            "projectId": "benchmark",
+            # the list response has the ids of the observations, GET /traces/{id} the observations themselves
+            "observations": [
+                f"observation-{index * self.config.observations_per_trace + offset:010d}"
+                for offset in range(self.config.observations_per_trace)
+            ],
+        }
+
+    def observation(self, index: int) -> dict:
+        rng = random.Random(self.config.seed * 1_000_003 + index + 7)
+        trace_index = index // max(self.config.observations_per_trace, 1)
+        model = rng.choice(("gpt-4o", "gpt-4o-mini"))
+        return {
+            "id": f"observation-{index:010d}",
+            "traceId": f"trace-{trace_index:010d}",
+            "type": rng.choice(("GENERATION", "SPAN", "EVENT")),
+            "name": rng.choice(("llm-call", "retrieve", "rerank")),
+            "startTime": self._timestamp(trace_index + 0.1),
+            "endTime": self._timestamp(trace_index + 0.9),
+            "completionStartTime": None,
+            "model": model,
+            "modelParameters": {"temperature": 0.2, "max_tokens": 1024},
+            "input": [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": self._text(self.config.payload_size // 4, rng)},
+            ],
+            "version": None,
+            "metadata": {"model": model},
+            "output": {"role": "assistant", "content": self._text(self.config.payload_size, rng)},
+            "usage": {"input": 1200, "output": 300, "total": 1500, "unit": "TOKENS"},
+            "level": "DEFAULT",
+            "statusMessage": None,
+            "parentObservationId": None,
+            "promptId": None,
+            "modelId": model,
+            "inputPrice": 0.0000025,
+            "outputPrice": 0.00001,
+            "totalPrice": None,
+            "calculatedInputCost": 0.003,
+            "calculatedOutputCost": 0.003,
+            "calculatedTotalCost": 0.006,
+            "latency": 0.8,
+            "totalToken": 1500,
+        }
+
+    def score(self, index: int) -> dict:
+        rng = random.Random(self.config.seed * 1_000_003 + index + 13)
+        trace_index = index // max(self.config.scores_per_trace, 1)
+        return {
+            "id": f"score-{index:010d}",
+            "traceId": f"trace-{trace_index:010d}",
+            "name": rng.choice(("helpfulness", "correctness")),
+            "value": rng.randint(0, 5),
+            "source": "API",
+            "observationId": None,
+            "timestamp": self._timestamp(trace_index + 1),
+            "comment": None,
+            "stringValue": None,
+            "dataType": "NUMERIC",
+            "trace": None,
+            "projectId": "benchmark",
+        }
+
+    def rows(self, path: str, query: dict[str, list[str]]) -> tuple[int, int, Callable[[int], dict]]:
+        """
+        Returns the (first index, number of rows, row factory) of the data set of the path.
+        """
+        config = self.config
+        match path:
+            case "traces":
+                return 0, config.traces, self.trace
+            case "scores":
+                return 0, config.traces * config.scores_per_trace, self.score
+            case "observations":
+                if "traceId" in query:
+                    trace_index = int(query["traceId"][0].rsplit("-", 1)[-1])
+                    first = trace_index * config.observations_per_trace
+                    return first, config.observations_per_trace if trace_index < config.traces else 0, self.observation
+                return 0, config.traces * config.observations_per_trace, self.observation
+        raise KeyError(path)
+
+    def trace_detail(self, trace_id: str) -> dict | None:
+        """
+        Returns the trace with its observations and scores embedded, like GET /traces/{id}, or None if it does not exist.
+        """
+        trace_index = int(trace_id.rsplit("-", 1)[-1])
+        if trace_index >= self.config.traces:
+            return None
+        observations_per_trace = self.config.observations_per_trace
+        scores_per_trace = self.config.scores_per_trace
+        return self.trace(trace_index) | {
+            "observations": [
+                self.observation(trace_index * observations_per_trace + index)
+                for index in range(observations_per_trace)
+            ],
+            "scores": [self.score(trace_index * scores_per_trace + index) for index in range(scores_per_trace)],
+        }
+
+    def is_throttled(self) -> bool:
+        if not self.config.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_requests = 0
+            self._window_requests += 1
+            return self._window_requests > self.config.rate_limit
+
+
+def make_handler(fake: FakeLangfuse) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, without this every response waits for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def send_json(self, status: int, body: dict, headers: dict[str, str] | None = None) -> None:
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+            with fake._lock:
+                fake.requests[(self.path_name, status)] += 1
+                fake.bytes_sent += len(content)
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            *_, parent_name, self.path_name = url.path.rstrip("/").split("/")
+            config = fake.config
+            if config.latency_ms:
+                time.sleep(config.latency_ms * (1 + random.random()) / 1000)
+            if fake.is_throttled():
+                self.send_json(
+                    429, {"message": "Rate limit exceeded"}, {"Retry-After": str(config.retry_after_seconds)}
+                )
+                return
+            if config.error_rate and random.random() < config.error_rate:
+                self.send_json(500, {"message": "Injected error"})
+                return
+            if parent_name == "traces":
+                trace_id, self.path_name = self.path_name, "traces/{id}"
+                if (trace := fake.trace_detail(trace_id)) is None:
+                    self.send_json(404, {"message": f"Trace {trace_id} not found"})
+                else:
+                    self.send_json(200, trace)
+                return
+            try:
+                first, total, row = fake.rows(self.path_name, query)
+            except KeyError:
+                self.send_json(404, {"message": f"Unknown path {url.path}"})
+                return
+            page = int(query.get("page", ["1"])[0])
+            limit = min(int(query.get("limit", ["50"])[0]), MAX_LIMIT)
+            start = (page - 1) * limit
+            data = [row(first + index) for index in range(start, min(start + limit, total))]
+            meta = {"page": page, "limit": limit, "totalItems": total, "totalPages": math.ceil(total / limit)}
+            self.send_json(200, {"data": data, "meta": meta})
+
+    return Handler
+
+
+def start_server(
+    config: FakeConfig, host: str = "127.0.0.1", port: int = 0
+) -> tuple[ThreadingHTTPServer, FakeLangfuse]:
+    """
+    Serves the fake API from a background thread, on a free port by default.
+    The base URL for the pipeline is f"http://{host}:{server.server_port}/api/public".
+    """
+    fake = FakeLangfuse(config)
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, fake
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--traces", type=int, default=FakeConfig.traces)
+    parser.add_argument("--observations-per-trace", type=int, default=FakeConfig.observations_per_trace)
+    parser.add_argument("--scores-per-trace", type=int, default=FakeConfig.scores_per_trace)
+    parser.add_argument("--payload-size", type=int, default=FakeConfig.payload_size)
+    parser.add_argument("--latency-ms", type=float, default=FakeConfig.latency_ms)
+    parser.add_argument("--error-rate", type=float, default=FakeConfig.error_rate)
+    parser.add_argument("--rate-limit", type=float, default=FakeConfig.rate_limit)
+    parser.add_argument("--seed", type=int, default=FakeConfig.seed)
+
+
+def config_from_arguments(arguments: argparse.Namespace) -> FakeConfig:
+    return FakeConfig(
+        traces=arguments.traces,
+        observations_per_trace=arguments.observations_per_trace,
+        scores_per_trace=arguments.scores_per_trace,
+        payload_size=arguments.payload_size,
+        latency_ms=arguments.latency_ms,
+        error_rate=arguments.error_rate,
+        rate_limit=arguments.rate_limit,
+        seed=arguments.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    arguments = parser.parse_args()
+    server, _ = start_server(config_from_arguments(arguments), arguments.host, arguments.port)
+    print(f"Serving the fake Langfuse API on http://{arguments.host}:{server.server_port}/api/public")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,136 @@
+"""
+Import-time budget of the Mage block modules (lodgify/data_loaders and lodgify/data_exporters).
+
+Every block is imported in a fresh interpreter, like Mage does on every run, and fails the check when:
+- its import takes longer than the budget of its kind (BUDGETS_MS, scaled with --scale for slower machines),
+- or it imports a module it does not need at import time (FORBIDDEN_MODULES), eg the Langfuse client in an exporter.
+The Langfuse credentials are removed from the environment of the imports, so a block that still resolves them at
+import time fails too. The heaviest top-level packages of every import are listed, from python -X importtime.
+
+    make import-budget
+    MAGE_REPO_PATH=lodgify python -m benchmarks.import_budget --scale 2 --json import_budget.json
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+# milliseconds, for a warm file system cache on the Mage image
+BUDGETS_MS = {"data_loaders": 1500, "data_exporters": 1000}
+# "{package}" is the package of the block (ai_tools or ai_assistant)
+FORBIDDEN_MODULES = {
+    "data_loaders": ("dotenv", "mage_ai.data_preparation.shared.secrets"),
+    "data_exporters": (
+        "dotenv",
+        "mage_ai.data_preparation.shared.secrets",
+        "lodgify.utils.{package}.utils_langfuse",
+        "tenacity",
+    ),
+}
+_CHILD = """
+import importlib, json, sys, time
+started_at = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - started_at, "modules": sorted(sys.modules)}))
+"""
+_IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)")
+
+
+@dataclass
+class ImportResult:
+    module: str
+    milliseconds: float
+    budget_milliseconds: float
+    forbidden_modules: list[str]
+    heaviest_packages_ms: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def passed(self) -> bool:
+        return self.milliseconds <= self.budget_milliseconds and not self.forbidden_modules
+
+
+def block_modules() -> list[str]:
+    return [
+        f"lodgify.{path.parent.name}.{path.stem}"
+        for kind in BUDGETS_MS
+        for path in sorted((REPO_ROOT / "lodgify" / kind).glob("*.py"))
+        if path.stem != "__init__"
+    ]
+
+
+def child_environment() -> dict[str, str]:
+    environment = {
+        name: value
+        for name, value in os.environ.items()
+        if not (name.startswith("langfuse_") and name.endswith("_credentials"))
+    }
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO_ROOT), environment.get("PYTHONPATH")]))
+    return environment
+
+
+def measure(module: str, scale: float) -> ImportResult:
+    kind = module.split(".")[1]
+    package = "ai_assistant" if module.split(".")[2].startswith("ai_assistant") else "ai_tools"
+    completed = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", _CHILD, module],
+        capture_output=True,
+        text=True,
+        env=child_environment(),
+        cwd=REPO_ROOT,
+        check=False,
+    )
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "no output"
+        raise RuntimeError(f"Importing {module} failed: {error}")
+    child_result = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    self_microseconds = Counter()
+    for line in completed.stderr.splitlines():
+        if match := _IMPORT_TIME_LINE.match(line):
+            self_microseconds[match.group(2).split(".", 1)[0]] += int(match.group(1))
+    forbidden = {name.format(package=package) for name in FORBIDDEN_MODULES[kind]}
+    return ImportResult(
+        module=module,
+        milliseconds=child_result["seconds"] * 1000,
+        budget_milliseconds=BUDGETS_MS[kind] * scale,
+        forbidden_modules=sorted(forbidden.intersection(child_result["modules"])),
+        heaviest_packages_ms={name: us / 1000 for name, us in self_microseconds.most_common(5)},
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", action="append", help="block modules to check, all of them by default")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the budgets, for slower machines")
+    parser.add_argument("--json", help="writes the results to this file")
+    arguments = parser.parse_args()
+
+    results = []
+    for module in arguments.module or block_modules():
+        result = measure(module, arguments.scale)
+        results.append(result)
+        heaviest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in result.heaviest_packages_ms.items())
+        print(
+            f"{'ok  ' if result.passed else 'FAIL'} {module:<54} {result.milliseconds:7.0f}ms "
+            f"(budget {result.budget_milliseconds:.0f}ms) {heaviest}",
+            flush=True,
+        )
+        if result.forbidden_modules:
+            print(f"     imports {', '.join(result.forbidden_modules)} at import time", flush=True)
+
+    if arguments.json:
+        report = [asdict(result) | {"passed": result.passed} for result in results]
+        Path(arguments.json).write_text(json.dumps(report, indent=2))
+    if not all(result.passed for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+End-to-end throughput benchmarks of the Langfuse import, against the local fake of the API (benchmarks/fake_langfuse.py).
+
+For every stage it reports the wall time, the pages (successful requests) and rows per second, the failed requests
+(429s and injected errors, retried by the pipeline) and the peak RSS of the process during the stage.
+Nothing is written to postgres unless --export is given: the exports then go to Benchmark* tables of the database
+configured for the package in lodgify/io_config.yaml, so point that profile to a local database.
+
+    make benchmark
+    MAGE_REPO_PATH=lodgify python -m benchmarks.run_benchmarks --traces 5000 --latency-ms 30 --json results.json
+"""
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+import psutil
+
+from benchmarks.fake_langfuse import FakeLangfuse, add_config_arguments, config_from_arguments, start_server
+
+
+class PeakRssSampler:
+    """
+    Samples the RSS of the process from a background thread while in the context, psutil only reports the current
+    value and the peak of resource.getrusage cannot be reset between stages.
+    """
+
+    def __init__(self, interval_seconds: float = 0.02) -> None:
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while True:
+            self.peak_bytes = max(self.peak_bytes, self._process.memory_info().rss)
+            if self._stop.wait(self.interval_seconds):
+                return
+
+    def __enter__(self) -> "PeakRssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+@dataclass
+class StageResult:
+    stage: str
+    wall_seconds: float
+    pages: int
+    failed_requests: int
+    rows: int
+    peak_rss_mib: float
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.wall_seconds if self.wall_seconds else 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.wall_seconds if self.wall_seconds else 0
+
+
+def count_requests(fake: FakeLangfuse) -> tuple[int, int]:
+    with fake._lock:
+        succeeded = sum(count for (_, status), count in fake.requests.items() if status == 200)
+        failed = sum(count for (_, status), count in fake.requests.items() if status != 200)
+    return succeeded, failed
+
+
+def run_stage(name: str, fake: FakeLangfuse, stage: Callable[[], int]) -> StageResult:
+    succeeded_before, failed_before = count_requests(fake)
+    with PeakRssSampler() as sampler:
+        started_at = time.perf_counter()
+        rows = stage()
+        wall_seconds = time.perf_counter() - started_at
+    succeeded_after, failed_after = count_requests(fake)
+    result = StageResult(
+        stage=name,
+        wall_seconds=wall_seconds,
+        pages=succeeded_after - succeeded_before,
+        failed_requests=failed_after - failed_before,
+        rows=rows,
+        peak_rss_mib=sampler.peak_bytes / 2**20,
+    )
+    print(
+        f"{name:<22} {result.wall_seconds:8.2f}s {result.pages:7d} pages {result.pages_per_second:8.1f} pages/s "
+        f"{result.rows:9d} rows {result.rows_per_second:10.1f} rows/s {result.failed_requests:5d} failed "
+        f"{result.peak_rss_mib:8.1f} MiB peak RSS",
+        flush=True,
+    )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--package", choices=("ai_tools", "ai_assistant"), default="ai_tools")
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        help="overrides the client rate limit (constants.LANGFUSE_REQUESTS_PER_SECOND) for the benchmark",
+    )
+    parser.add_argument("--export", action="store_true", help="also benchmark the export to postgres")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="writes the configuration and the results to this file")
+    add_config_arguments(parser)
+    arguments = parser.parse_args()
+
+    fake_config = config_from_arguments(arguments)
+    server, fake = start_server(fake_config)
+    # read when utils_langfuse is imported, so it has to be set before importing the loaders
+    os.environ["LANGFUSE_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/api/public"
+    constants = importlib.import_module(f"lodgify.utils.{arguments.package}.constants")
+    os.environ.setdefault(constants.get_config_mapper()["secret_name"], "benchmark-public-key:benchmark-secret-key")
+    # the watermarks and the observation sync markers are in postgres
+    constants.INCREMENTAL_SYNC = arguments.export
+    constants.SKIP_UNCHANGED_TRACES = arguments.export
+    constants.PAYLOAD_OFFLOAD = constants.PAYLOAD_OFFLOAD and arguments.export
+    constants.SPILL_DIR = tempfile.mkdtemp(prefix="langfuse_benchmark_spill_")
+
+    utils_langfuse = importlib.import_module(f"lodgify.utils.{arguments.package}.utils_langfuse")
+    utils_postgres = importlib.import_module(f"lodgify.utils.{arguments.package}.utils_postgres")
+    utils_handoff = importlib.import_module(f"lodgify.utils.{arguments.package}.utils_handoff")
+    fetch_traces = importlib.import_module(f"lodgify.data_loaders.{arguments.package}_fetch_traces")
+    fetch_observations = importlib.import_module(f"lodgify.data_loaders.{arguments.package}_fetch_observations")
+    fetch_scores = importlib.import_module(f"lodgify.data_loaders.{arguments.package}_fetch_scores")
+    logger = importlib.import_module(f"lodgify.utils.{arguments.package}.logger").logger
+    logger.remove()
+    logger.add(sys.stderr, level=arguments.log_level, format="{level} | {message}")
+
+    if arguments.requests_per_second:
+        rate_limiter = utils_langfuse.rate_limiter
+        rate_limiter.max_rate = rate_limiter.rate = rate_limiter.capacity = arguments.requests_per_second
+        rate_limiter.recovery_step = arguments.requests_per_second / 50
+
+    run_kwargs = {"execution_date": datetime.now(timezone.utc)}
+    start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(constants.DAYS_BACK, **run_kwargs)
+    frames = {}
+
+    def load(entity: str, loader: Callable, *args) -> int:
+        # includes writing the output for the downstream blocks and reading it back, see utils_handoff
+        frames[entity] = utils_handoff.take_over(loader(*args, **run_kwargs))
+        return len(frames[entity])
+
+    def export(entity: str) -> int:
+        data = frames[entity]
+        batches = (
+            data.iloc[start : start + constants.BATCH_SIZE] for start in range(0, len(data), constants.BATCH_SIZE)
+        )
+        return utils_postgres.export_batches(batches, "public", f"Benchmark{entity.capitalize()}")
+
+    print(f"Fake Langfuse: {fake_config}")
+    stages = [
+        (
+            "fetch_all_pages traces",
+            lambda: len(
+                utils_langfuse.fetch_all_pages(
+                    "traces", start_from_date, end_date, concurrency=constants.PAGE_FETCH_CONCURRENCY
+                )
+            ),
+        ),
+        ("load_traces", lambda: load("traces", fetch_traces.load_traces)),
+        ("load_observations", lambda: load("observations", fetch_observations.load_observations, frames["traces"])),
+        ("load_scores", lambda: load("scores", fetch_scores.load_scores)),
+    ]
+    if arguments.export:
+        stages += [
+            (f"export {entity}", lambda entity=entity: export(entity))
+            for entity in ("traces", "observations", "scores")
+        ]
+
+    try:
+        results = [run_stage(name, fake, stage) for name, stage in stages]
+    finally:
+        server.shutdown()
+        shutil.rmtree(constants.SPILL_DIR, ignore_errors=True)
+
+    if arguments.json:
+        report = {
+            "package": arguments.package,
+            "fake_langfuse": asdict(fake_config),
+            "results": [
+                asdict(result)
+                | {"pages_per_second": result.pages_per_second, "rows_per_second": result.rows_per_second}
+                for result in results
+            ],
+        }
+        Path(arguments.json).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import pandas as pd
+
+from lodgify.utils.ai_assistant import utils_handoff, utils_metrics, utils_postgres, utils_profiling
+from lodgify.utils.ai_assistant.logger import logger
+
+if "data_exporter" not in globals():
+    from mage_ai.data_preparation.decorators import data_exporter
+
+
+@data_exporter
+@utils_metrics.report_metrics("ai_assistant_save_all")
+@utils_profiling.profile_block("ai_assistant_save_all")
+def export_data_to_postgres(
+    traces: pd.DataFrame | dict, observations: pd.DataFrame | dict, scores: pd.DataFrame | dict, **kwargs
+) -> None:
+    """
+    Saves the outputs of the traces, observations and scores loaders in one block, at the same time with
+    constants.PARALLEL_EXPORT (see utils_postgres.save_entities), instead of the three save blocks one after
+    the other. It is the exporter of the ai_assistant_langfuse_import pipeline, where its upstream blocks are
+    ai_assistant_fetch_traces, ai_assistant_fetch_observations and ai_assistant_fetch_scores, in this order.
+    """
+    utils_postgres.save_entities(
+        {
+            "traces": utils_handoff.take_over(traces),
+            "observations": utils_handoff.take_over(observations),
+            "scores": utils_handoff.take_over(scores),
+        },
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    # this is only for testing as a script locally, mage uses decorators to run the code
+    logger.debug("running __main__")
+    export_data_to_postgres(
+        utils_handoff.read_frame("traces.arrow"),
+        utils_handoff.read_frame("observations.arrow"),
+        utils_handoff.read_frame("scores.arrow"),
+    )
@@ -1,6 +1,6 @@
 import pandas as pd
 
-from lodgify.utils.ai_assistant import utils_postgres
+from lodgify.utils.ai_assistant import utils_handoff, utils_metrics, utils_postgres, utils_profiling
 from lodgify.utils.ai_assistant.logger import logger
 
 if "data_exporter" not in globals():
@@ -8,8 +8,10 @@ if "data_exporter" not in globals():
 
 
 @data_exporter
-def export_data_to_postgres(data: pd.DataFrame, **kwargs) -> None:
-    utils_postgres.export_data(data, schema_name="public", table_name="LangfuseScores")
+@utils_metrics.report_metrics("ai_assistant_save_scores")
+@utils_profiling.profile_block("ai_assistant_save_scores")
+def export_data_to_postgres(data: pd.DataFrame | dict, **kwargs) -> None:
+    utils_postgres.save_entity("scores", utils_handoff.take_over(data), **kwargs)
 
 
 if __name__ == "__main__":
@@ -17,5 +19,5 @@ if __name__ == "__main__":
     logger.debug("running __main__")
     import pandas as pd
 
-    data = pd.read_pickle("scores.pkl")
+    data = utils_handoff.read_frame("scores.arrow")
     export_data_to_postgres(data)
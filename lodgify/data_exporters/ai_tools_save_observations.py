@@ -1,4 +1,4 @@
-from lodgify.utils.ai_tools import utils_postgres
+from lodgify.utils.ai_tools import utils_handoff, utils_metrics, utils_postgres, utils_profiling
 from lodgify.utils.ai_tools.logger import logger
 
 if "data_exporter" not in globals():
@@ -6,14 +6,14 @@ if "data_exporter" not in globals():
 
 
 @data_exporter
+@utils_metrics.report_metrics("ai_tools_save_observations")
+@utils_profiling.profile_block("ai_tools_save_observations")
 def export_data_to_postgres(data, **kwargs) -> None:
-    utils_postgres.export_data(data, schema_name="public", table_name="LangfuseObservations")
+    utils_postgres.save_entity("observations", utils_handoff.take_over(data), **kwargs)
 
 
 if __name__ == "__main__":
     # this is only for testing as a script locally, mage uses decorators to run the code
     logger.debug("running __main__")
-    import pandas as pd
-
-    data = pd.read_pickle("observations.pkl")
+    data = utils_handoff.read_frame("observations.arrow")
     export_data_to_postgres(data)
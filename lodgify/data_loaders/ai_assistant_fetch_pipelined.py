@@ -0,0 +1,260 @@
+import queue
+import time
+import uuid
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pandas as pd
+
+from lodgify.utils.ai_assistant import (
+    constants,
+    schemas,
+    utils_langfuse,
+    utils_metrics,
+    utils_payloads,
+    utils_postgres,
+    utils_profiling,
+    utils_spill,
+)
+from lodgify.utils.ai_assistant.logger import logger
+
+if "data_loader" not in globals():
+    from mage_ai.data_preparation.decorators import data_loader
+if "test" not in globals():
+    from mage_ai.data_preparation.decorators import test
+
+# put in a queue once by every producer, so that the consumers know when to stop
+_END = object()
+
+
+def get_window(entity: str, **kwargs) -> tuple[str, str]:
+    start_from_date, end_date = utils_postgres.get_window(**kwargs)
+    if constants.INCREMENTAL_SYNC and not constants.REPLACE_WINDOW:
+        watermark = utils_postgres.get_watermark(entity)
+        start_from_date = utils_langfuse.apply_watermark(start_from_date, end_date, watermark)
+    return start_from_date, end_date
+
+
+def iter_queue(items: queue.Queue, producers: int) -> Iterator:
+    """
+    Yields the items of the queue until all the producers are done.
+    """
+    while producers:
+        item = items.get()
+        if item is _END:
+            producers -= 1
+        else:
+            yield item
+
+
+def export_pages(
+    pages: Iterable[list[dict]],
+    columns: tuple[schemas.Column, ...],
+    time_column: str,
+    table_name: str,
+    replace_days: Iterable[date] = (),
+) -> tuple[int, pd.Series]:
+    """
+    Exports the given pages batch by batch as they arrive, see utils_postgres.export_batches.
+    Returns the number of exported rows and the latest time of every batch, for the watermark.
+    """
+    latest_times = []
+
+    def iter_frames() -> Iterator[pd.DataFrame]:
+        for batch in utils_langfuse.batch_pages(pages, constants.BATCH_SIZE):
+            frame = utils_payloads.offload_payloads(schemas.build_frame(batch, columns))
+            latest_times.append(pd.to_datetime(frame[time_column], utc=True, format="ISO8601").max())
+            yield frame
+
+    exported_rows = utils_postgres.export_batches(
+        iter_frames(), schema_name="public", table_name=table_name, replace_days=replace_days
+    )
+    return exported_rows, pd.Series(latest_times, dtype=object)
+
+
+def select_changed_traces(page_data: list[dict], changed_markers: dict[str, str]) -> list[str]:
+    """
+    Returns the ids of the traces of the page that are new or changed since their observations were exported,
+    and adds their markers to 'changed_markers', like the observations loader (see find_changed_traces there).
+    """
+    traces = schemas.build_frame(page_data, schemas.TRACE_COLUMNS)
+    markers = dict(zip(traces["Id"], utils_postgres.compute_content_hash(traces), strict=True))
+    synced = utils_postgres.get_observation_sync(list(markers))
+    changed = {trace_id: marker for trace_id, marker in markers.items() if synced.get(trace_id, (None, 0))[0] != marker}
+    changed_markers.update(changed)
+    return list(changed)
+
+
+def stream_traces(
+    start_from_date: str,
+    end_date: str,
+    trace_ids: queue.Queue,
+    consumers: int,
+    changed_markers: dict[str, str] | None,
+    replace_days: Iterable[date],
+) -> tuple[int, pd.Series]:
+    """
+    Exports the traces of the window, publishing the id of every trace as soon as its page arrives.
+    With 'changed_markers', only the traces that are new or changed are published, see select_changed_traces.
+    """
+
+    def publish_trace_ids(pages: Iterable[list[dict]]) -> Iterator[list[dict]]:
+        for page_data in pages:
+            if changed_markers is None:
+                page_trace_ids = [trace["id"] for trace in page_data]
+            else:
+                page_trace_ids = select_changed_traces(page_data, changed_markers)
+            for trace_id in page_trace_ids:
+                trace_ids.put(trace_id)  # blocks while the observation workers are behind
+            yield page_data
+
+    try:
+        pages = utils_langfuse.iter_pages(
+            "traces", start_from_date, end_date, concurrency=constants.PAGE_FETCH_CONCURRENCY, spill=True
+        )
+        return export_pages(
+            publish_trace_ids(pages), schemas.TRACE_COLUMNS, "Timestamp", "LangfuseTraces", replace_days
+        )
+    finally:
+        for _ in range(consumers):
+            trace_ids.put(_END)
+
+
+def fetch_observations_worker(
+    trace_ids: queue.Queue,
+    observations: queue.Queue,
+    concurrency: utils_langfuse.AdaptiveConcurrency,
+    observation_counts: dict[str, int],
+):
+    """
+    Fetches the observations of every published trace, without a time filter, since the traces are
+    already the ones of the window (and their observations can start outside of it), and counts them by trace.
+    Only as many workers as the adaptive concurrency allows fetch at the same time.
+    """
+    failed = False
+    for trace_id in iter_queue(trace_ids, producers=1):
+        if failed:
+            continue  # only draining the queue, so that the trace stream never blocks on it
+        try:
+            with concurrency.slot():
+                trace_observations = utils_langfuse.fetch_trace_observations(trace_id, None, None)
+            observation_counts[trace_id] = len(trace_observations)
+            observations.put(trace_observations)
+        except Exception:
+            logger.exception(f"Error fetching the observations of trace {trace_id}")
+            failed = True
+    observations.put(_END)
+    if failed:
+        raise RuntimeError("Could not fetch the observations of all the traces")
+
+
+def stream_observations(observations: queue.Queue, producers: int) -> tuple[int, pd.Series]:
+    pages = iter_queue(observations, producers)
+    try:
+        return export_pages(pages, schemas.OBSERVATION_COLUMNS, "StartTime", "LangfuseObservations")
+    finally:
+        for _ in pages:
+            pass  # draining the queue after a failed export, so that the workers never block on it
+
+
+def stream_scores(start_from_date: str, end_date: str, replace_days: Iterable[date]) -> tuple[int, pd.Series]:
+    pages = utils_langfuse.iter_pages(
+        "scores", start_from_date, end_date, concurrency=constants.PAGE_FETCH_CONCURRENCY, spill=True
+    )
+    return export_pages(pages, schemas.SCORE_COLUMNS, "Timestamp", "LangfuseScores", replace_days)
+
+
+def timed(stream, *args) -> tuple[int, pd.Series, float]:
+    start = time.monotonic()
+    with utils_metrics.timed_stage(stream.__name__):
+        exported_rows, latest_times = stream(*args)
+    return exported_rows, latest_times, time.monotonic() - start
+
+
+@data_loader
+@utils_metrics.report_metrics("ai_assistant_fetch_pipelined")
+@utils_profiling.profile_block("ai_assistant_fetch_pipelined")
+def load_pipelined(*args, **kwargs):
+    """
+    Fetches and exports traces, observations and scores at the same time, instead of one block after the other:
+    the trace pager publishes the trace ids to a bounded queue as every page arrives, observation workers fetch
+    the observations of these traces meanwhile, and the scores are fetched in parallel with both.
+    Every stream exports its own batches, so this block only returns a summary of the run.
+    Honours constants.SKIP_UNCHANGED_TRACES and constants.REPLACE_WINDOW like the other loaders and exporters,
+    except that the observations are fetched per trace, so their partitions are never replaced.
+    """
+    logger.info(f"Run params {args=}, {kwargs=}")
+    traces_window = get_window("traces", **kwargs)
+    scores_window = get_window("scores", **kwargs)
+    logger.info(f"Fetching data {traces_window=}, {scores_window=}")
+    replace_days = utils_postgres.get_window_days(**kwargs) if constants.REPLACE_WINDOW else []
+    changed_markers = {} if constants.SKIP_UNCHANGED_TRACES and not constants.REPLACE_WINDOW else None
+    observation_counts = {}
+
+    workers = constants.OBSERVATION_FETCH_MAX_WORKERS
+    concurrency = utils_langfuse.AdaptiveConcurrency(
+        "pipelined observations",
+        initial=constants.OBSERVATION_FETCH_WORKERS,
+        floor=constants.OBSERVATION_FETCH_MIN_WORKERS,
+        ceiling=workers,
+    )
+    trace_ids = queue.Queue(maxsize=constants.PIPELINE_QUEUE_SIZE)
+    observations = queue.Queue(maxsize=2 * workers)
+    with ThreadPoolExecutor(max_workers=workers + 3) as executor:
+        streams = {
+            "traces": executor.submit(
+                timed, stream_traces, *traces_window, trace_ids, workers, changed_markers, replace_days
+            ),
+            "observations": executor.submit(timed, stream_observations, observations, workers),
+            "scores": executor.submit(timed, stream_scores, *scores_window, replace_days),
+        }
+        worker_futures = [
+            executor.submit(fetch_observations_worker, trace_ids, observations, concurrency, observation_counts)
+            for _ in range(workers)
+        ]
+
+    concurrency.log_summary()
+    errors = [(entity, future.exception()) for entity, future in streams.items() if future.exception()]
+    errors += [("observations", future.exception()) for future in worker_futures if future.exception()]
+    for entity, error in errors:
+        logger.opt(exception=error).error(f"The {entity} stream failed")
+    if errors:
+        raise RuntimeError(f"Pipelined load failed for {sorted({entity for entity, _ in errors})}")
+
+    # the watermarks only move once every stream succeeded, so that a failed run is fully fetched again
+    summary = []
+    for entity, future in streams.items():
+        exported_rows, latest_times, seconds = future.result()
+        utils_postgres.update_watermark(entity, latest_times)
+        utils_postgres.ensure_indexes(utils_postgres.ENTITY_TABLES[entity][0])
+        logger.info(f"Exported {exported_rows} {entity} in {seconds:.1f}s")
+        summary.append({"Entity": entity, "Rows": exported_rows, "Seconds": round(seconds, 1)})
+    if changed_markers is not None:
+        logger.info(f"Fetched the observations of {len(changed_markers)} new or changed traces, skipped the others")
+        # staged and committed by this block, which fetched and exported the observations
+        run_id = uuid.uuid4().hex
+        utils_postgres.stage_observation_sync(
+            {trace_id: (marker, observation_counts.get(trace_id, 0)) for trace_id, marker in changed_markers.items()},
+            run_id,
+        )
+        utils_postgres.commit_observation_sync(run_id)
+
+    # the observations are fetched per trace, which does not spill
+    utils_spill.clear_spill("traces", traces_window[1])
+    utils_spill.clear_spill("scores", scores_window[1])
+    utils_langfuse.log_connection_stats()
+    return pd.DataFrame(summary)
+
+
+@test
+def test_output(output, *args) -> None:
+    """Template code for testing the output of the block."""
+    assert output is not None, "The output is undefined"
+
+
+if __name__ == "__main__":
+    # this is only for testing as a script locally, mage uses decorators to run the code
+    logger.debug("running __main__")
+    summary_df = load_pipelined()
+    logger.debug(summary_df)
@@ -1,9 +1,21 @@
-import json
+import math
+from collections import Counter, defaultdict
+from collections.abc import Iterator
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 
-from lodgify.utils.ai_tools import constants, utils_langfuse
+from lodgify.utils.ai_tools import (
+    constants,
+    schemas,
+    utils_backfill,
+    utils_handoff,
+    utils_langfuse,
+    utils_metrics,
+    utils_payloads,
+    utils_postgres,
+    utils_profiling,
+)
 from lodgify.utils.ai_tools.logger import logger
 
 if "data_loader" not in globals():
@@ -12,66 +24,71 @@ if "test" not in globals():
     from mage_ai.data_preparation.decorators import test
 
 
-def fetch_observations_for_trace(trace_id, start_from_date: str, end_date: str):
-    params = {
-        "traceId": trace_id,
-    }
-    observations_data = utils_langfuse.fetch_all_pages("observations", start_from_date, end_date, params)
-
-    return [
-        {
-            "Id": observation["id"],
-            "TraceId": trace_id,
-            "Type": observation["type"],
-            "Name": observation.get("name"),
-            "StartTime": observation["startTime"],
-            "EndTime": observation.get("endTime"),
-            "CompletionStartTime": observation.get("completionStartTime"),
-            "Model": observation.get("model"),
-            "ModelParameters": json.dumps(observation["modelParameters"]) if observation["modelParameters"] else None,
-            "Input": json.dumps(observation.get("input")) if observation.get("input") else None,
-            "Version": observation.get("version"),
-            "Metadata": json.dumps(observation.get("metadata")) if observation.get("metadata") else None,
-            "Output": json.dumps(observation.get("output")) if observation.get("output") else None,
-            "Usage": json.dumps(observation.get("usage")) if observation.get("usage") else None,
-            "Level": observation["level"],
-            "StatusMessage": observation.get("statusMessage"),
-            "ParentObservationId": observation.get("parentObservationId"),
-            "PromptId": observation.get("promptId"),
-            "ModelId": observation.get("modelId"),
-            "InputPrice": observation.get("inputPrice"),
-            "OutputPrice": observation.get("outputPrice"),
-            "TotalPrice": observation.get("totalPrice"),
-            "CalculatedInputCost": observation.get("calculatedInputCost"),
-            "CalculatedOutputCost": observation.get("calculatedOutputCost"),
-            "CalculatedTotalCost": observation.get("calculatedTotalCost"),
-            "Latency": observation.get("latency"),
-            "TotalToken": observation.get("totalToken"),
-        }
-        for observation in observations_data
-    ]
+def fetch_observations_for_trace(trace_id, start_from_date: str | None, end_date: str | None):
+    return utils_langfuse.fetch_trace_observations(trace_id, start_from_date, end_date)
 
 
-@data_loader
-def load_observations(data: pd.DataFrame, *args, **kwargs):
-    if data.empty:
-        logger.warning("Not loading observations, no traces found.")
-        return pd.DataFrame()
+def iter_observation_frames(start_from_date: str, end_date: str, spill: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Yields all the observations of the window (of any trace) as DataFrames of constants.BATCH_SIZE rows.
+    """
+    for observations_data in utils_langfuse.iter_batches(
+        "observations",
+        start_from_date,
+        end_date,
+        constants.BATCH_SIZE,
+        concurrency=constants.PAGE_FETCH_CONCURRENCY,
+        spill=spill,
+    ):
+        yield utils_payloads.offload_payloads(schemas.build_frame(observations_data, schemas.OBSERVATION_COLUMNS))
+
+
+def fetch_observations_for_window(
+    trace_ids: list[str] | None, start_from_date: str, end_date: str
+) -> dict[str, list[dict]]:
+    """
+    Pages through all the observations of the window once and groups them by trace locally,
+    keeping only the observations of the given traces (all of them without trace_ids).
+    """
+    wanted_trace_ids = None if trace_ids is None else set(trace_ids)
+    observations_count = 0
+    observations_by_trace = defaultdict(list)
+    # filtering page by page, so that the observations of other traces are not kept in memory
+    for observations_data in utils_langfuse.iter_pages(
+        "observations", start_from_date, end_date, concurrency=constants.PAGE_FETCH_CONCURRENCY, spill=True
+    ):
+        observations_count += len(observations_data)
+        for observation in observations_data:
+            if wanted_trace_ids is None or observation.get("traceId") in wanted_trace_ids:
+                observations_by_trace[observation["traceId"]].append(observation)
+    logger.info(
+        f"Fetched {observations_count} observations in the window, "
+        f"{sum(map(len, observations_by_trace.values()))} of them for {len(observations_by_trace)} traces"
+    )
+    return observations_by_trace
+
 
+def fetch_observations_per_trace(trace_ids: list[str], start_from_date: str | None, end_date: str | None) -> list[dict]:
+    if not trace_ids:
+        return []
     observations = []
-    logger.info(f"Run params {args=}, {kwargs=}")
-    start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(constants.DAYS_BACK, **kwargs)
-    logger.info(f"Fetching data {start_from_date=}, {end_date=}")
-    trace_ids = data["Id"].tolist()
     # we need to parallelize fetching so that it is not too slow. The reason is that
-    # we can only fetch observations for a trace at a time (ie, not all the observations for all the traces at once)
-    # not too high to respect API limits: https://langfuse.com/faq/all/api-limits
+    # in this mode we fetch observations for a trace at a time (ie, not all the observations for all the traces at once)
+    # the concurrency adapts to the latency and the 429s, to respect API limits: https://langfuse.com/faq/all/api-limits
+    concurrency = utils_langfuse.AdaptiveConcurrency(
+        "observations per trace",
+        initial=constants.OBSERVATION_FETCH_WORKERS,
+        floor=constants.OBSERVATION_FETCH_MIN_WORKERS,
+        ceiling=constants.OBSERVATION_FETCH_MAX_WORKERS,
+    )
+
+    def fetch(trace_id: str) -> list[dict]:
+        with concurrency.slot():
+            return fetch_observations_for_trace(trace_id, start_from_date, end_date)
+
     processed_count = 0
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        future_to_trace = {
-            executor.submit(fetch_observations_for_trace, trace_id, start_from_date, end_date): trace_id
-            for trace_id in trace_ids
-        }
+    with ThreadPoolExecutor(max_workers=constants.OBSERVATION_FETCH_MAX_WORKERS) as executor:
+        future_to_trace = {executor.submit(fetch, trace_id): trace_id for trace_id in trace_ids}
         nth_trace = 100
         logger.info(f"Will be logging completion of every {nth_trace=}")
 
@@ -89,7 +106,124 @@ def load_observations(data: pd.DataFrame, *args, **kwargs):
                 logger.exception(f"Error processing trace {trace_id}")
                 raise  # Re-raise the exception after logging
 
-    return pd.DataFrame(observations) if observations else pd.DataFrame()
+    concurrency.log_summary()
+    return observations
+
+
+def find_changed_traces(traces: pd.DataFrame) -> tuple[dict[str, str], int]:
+    """
+    Returns the markers of the traces that are new or changed since their observations were last exported,
+    and the number of observations exported for the unchanged ones.
+    The marker is the content hash of the trace row, which holds the ids of its observations (ObservationIds)
+    and the latency and the cost that Langfuse derives from them, so a new observation changes it, even without any cost.
+    A change to an existing observation that leaves the trace row as it is (eg to its output) is only loaded
+    by the runs that do not skip the unchanged traces (without SKIP_UNCHANGED_TRACES, or with REPLACE_WINDOW).
+    """
+    markers = dict(zip(traces["Id"], utils_postgres.compute_content_hash(traces), strict=True))
+    synced = utils_postgres.get_observation_sync(list(markers))
+    changed_markers = {
+        trace_id: marker for trace_id, marker in markers.items() if synced.get(trace_id, (None, 0))[0] != marker
+    }
+    unchanged_observations = sum(count for trace_id, (_, count) in synced.items() if trace_id not in changed_markers)
+    logger.info(
+        f"{len(changed_markers)} of {len(markers)} traces are new or changed since their observations were exported, "
+        f"skipping the {len(markers) - len(changed_markers)} others ({unchanged_observations} observations)"
+    )
+    return changed_markers, unchanged_observations
+
+
+def backfill_observations(**kwargs) -> pd.DataFrame:
+    """
+    Backfill mode, enabled with the runtime variable 'backfill_days': fetches and exports the observations of the
+    'backfill_days' before the execution date shard by shard (see utils_backfill.run_backfill),
+    so nothing is returned to the exporter block.
+    """
+    start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(int(kwargs["backfill_days"]), **kwargs)
+    utils_backfill.run_backfill(
+        "observations",
+        start_from_date,
+        end_date,
+        lambda shard_start, shard_end: utils_postgres.export_batches(
+            iter_observation_frames(shard_start, shard_end), schema_name="public", table_name="LangfuseObservations"
+        ),
+        shard=kwargs.get("backfill_shard", constants.BACKFILL_SHARD),
+    )
+    utils_langfuse.log_connection_stats()
+    return pd.DataFrame()
+
+
+@data_loader
+@utils_metrics.report_metrics("ai_tools_fetch_observations")
+@utils_profiling.profile_block("ai_tools_fetch_observations")
+def load_observations(data: pd.DataFrame | dict, *args, **kwargs):
+    """
+    Fetches the observations of the traces loaded by the upstream block.
+    They are returned as a single DataFrame for the exporter, see utils_handoff.hand_over.
+    """
+    if kwargs.get("backfill_days"):
+        # discards the pending markers of an earlier run, the exporter gets no observations from this one
+        utils_postgres.stage_observation_sync({}, utils_postgres.get_run_id(**kwargs))
+        return backfill_observations(**kwargs)
+    data = utils_handoff.take_over(data)
+    if data.empty:
+        logger.warning("Not loading observations, no traces found.")
+        utils_postgres.stage_observation_sync({}, utils_postgres.get_run_id(**kwargs))
+        return pd.DataFrame()
+
+    logger.info(f"Run params {args=}, {kwargs=}")
+    start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(constants.DAYS_BACK, **kwargs)
+    if constants.INCREMENTAL_SYNC and not constants.REPLACE_WINDOW:
+        watermark = utils_postgres.get_watermark("observations")
+        start_from_date = utils_langfuse.apply_watermark(start_from_date, end_date, watermark)
+    logger.info(f"Fetching data {start_from_date=}, {end_date=} with {constants.OBSERVATION_FETCH_MODE=}")
+    trace_ids = data["Id"].tolist()
+    fetch_mode = constants.OBSERVATION_FETCH_MODE
+    changed_markers = None
+    run_id = utils_postgres.get_run_id(**kwargs)
+    skip_unchanged = constants.SKIP_UNCHANGED_TRACES and not constants.REPLACE_WINDOW
+    if skip_unchanged and run_id is None:
+        logger.warning("Not skipping the unchanged traces, the run has no execution date to tie their markers to")
+        skip_unchanged = False
+    if skip_unchanged:
+        changed_markers, unchanged_observations = find_changed_traces(data)
+        trace_ids = list(changed_markers)
+        # the window holds at least the observations of the unchanged traces, when that is more pages than there are
+        # changed traces, one request per changed trace is cheaper
+        if fetch_mode == "window" and 0 < len(trace_ids) < math.ceil(
+            unchanged_observations / utils_langfuse.PAGE_LIMIT
+        ):
+            logger.info(f"Fetching observations per trace, {len(trace_ids)} changed traces take fewer requests")
+            fetch_mode = "trace"
+            start_from_date = end_date = None
+
+    if not trace_ids:
+        observations = []
+    elif fetch_mode == "window":
+        # the partitions of the window are replaced with the fetched observations, so none of them may be left out
+        observations_by_trace = fetch_observations_for_window(
+            None if constants.REPLACE_WINDOW else trace_ids, start_from_date, end_date
+        )
+        observations = [obs for trace_obs in observations_by_trace.values() for obs in trace_obs]
+        # the observations of these traces (if any) started outside of the window, so we fetch them per trace
+        # without the time filter
+        missing_trace_ids = [trace_id for trace_id in trace_ids if trace_id not in observations_by_trace]
+        logger.info(f"Fetching observations per trace for {len(missing_trace_ids)} traces not found in the window")
+        observations.extend(fetch_observations_per_trace(missing_trace_ids, None, None))
+    else:
+        observations = fetch_observations_per_trace(trace_ids, start_from_date, end_date)
+
+    utils_langfuse.log_connection_stats()
+    if changed_markers is not None:
+        observation_counts = Counter(observation["traceId"] for observation in observations)
+        utils_postgres.stage_observation_sync(
+            {trace_id: (marker, observation_counts[trace_id]) for trace_id, marker in changed_markers.items()},
+            run_id,
+        )
+    if not observations:
+        return pd.DataFrame()
+    observations_df = utils_payloads.offload_payloads(schemas.build_frame(observations, schemas.OBSERVATION_COLUMNS))
+    schemas.log_memory_usage(observations_df, "observations")
+    return utils_handoff.hand_over(observations_df, "ai_tools_fetch_observations")
 
 
 @test
@@ -101,7 +235,7 @@ def test_output(output, *args) -> None:
 if __name__ == "__main__":
     # this is only for testing as a script locally, mage uses decorators to run the code
     logger.debug("running __main__")
-    traces_df = pd.read_pickle("traces.pkl")
-    observations_df = load_observations(traces_df)
-    observations_df.to_pickle("observations.pkl")
+    traces_df = utils_handoff.read_frame("traces.arrow")
+    observations_df = utils_handoff.take_over(load_observations(traces_df))
+    utils_handoff.write_frame(observations_df, "observations.arrow")
     logger.debug(observations_df)
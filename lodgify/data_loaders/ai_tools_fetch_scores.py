@@ -1,7 +1,17 @@
-import json
+from collections.abc import Iterator
+
 import pandas as pd
 
-from lodgify.utils.ai_tools import constants, utils_langfuse
+from lodgify.utils.ai_tools import (
+    constants,
+    schemas,
+    utils_backfill,
+    utils_handoff,
+    utils_langfuse,
+    utils_metrics,
+    utils_postgres,
+    utils_profiling,
+)
 from lodgify.utils.ai_tools.logger import logger
 
 if "data_loader" not in globals():
@@ -10,31 +20,64 @@ if "test" not in globals():
     from mage_ai.data_preparation.decorators import test
 
 
+def iter_score_frames(start_from_date: str, end_date: str, spill: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Yields the scores of the window as DataFrames of constants.BATCH_SIZE rows,
+    so that the raw API data is only held in memory for one batch at a time.
+    """
+    for scores_data in utils_langfuse.iter_batches(
+        "scores",
+        start_from_date,
+        end_date,
+        constants.BATCH_SIZE,
+        concurrency=constants.PAGE_FETCH_CONCURRENCY,
+        spill=spill,
+    ):
+        yield schemas.build_frame(scores_data, schemas.SCORE_COLUMNS)
+
+
+def backfill_scores(**kwargs) -> pd.DataFrame:
+    """
+    Backfill mode, enabled with the runtime variable 'backfill_days': fetches and exports the scores of the
+    'backfill_days' before the execution date shard by shard (see utils_backfill.run_backfill),
+    so nothing is returned to the exporter block.
+    """
+    start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(int(kwargs["backfill_days"]), **kwargs)
+    utils_backfill.run_backfill(
+        "scores",
+        start_from_date,
+        end_date,
+        lambda shard_start, shard_end: utils_postgres.export_batches(
+            iter_score_frames(shard_start, shard_end), schema_name="public", table_name="LangfuseScores"
+        ),
+        shard=kwargs.get("backfill_shard", constants.BACKFILL_SHARD),
+    )
+    utils_langfuse.log_connection_stats()
+    return pd.DataFrame()
+
+
 @data_loader
+@utils_metrics.report_metrics("ai_tools_fetch_scores")
+@utils_profiling.profile_block("ai_tools_fetch_scores")
 def load_scores(*args, **kwargs):
+    """
+    Fetches the scores of the DAYS_BACK window (from the watermark with constants.INCREMENTAL_SYNC).
+    The batches are concatenated into a single DataFrame for the exporter, see utils_handoff.hand_over.
+    """
     logger.info(f"Run params {args=}, {kwargs=}")
+    if kwargs.get("backfill_days"):
+        return backfill_scores(**kwargs)
     start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(constants.DAYS_BACK, **kwargs)
+    if constants.INCREMENTAL_SYNC and not constants.REPLACE_WINDOW:
+        watermark = utils_postgres.get_watermark("scores")
+        start_from_date = utils_langfuse.apply_watermark(start_from_date, end_date, watermark)
     logger.info(f"Fetching data {start_from_date=}, {end_date=}")
-    scores_data = utils_langfuse.fetch_all_pages("scores", start_from_date, end_date)
-    scores_dicts = [
-        {
-            "Id": score["id"],
-            "TraceId": score["traceId"],
-            "Name": score["name"],
-            "Value": score["value"],
-            "Source": score.get("source"),
-            "ObservationId": score.get("observationId"),
-            "Timestamp": score["timestamp"],
-            "Comment": score.get("comment"),
-            "StringValue": score.get("stringValue"),
-            "DataType": score.get("dataType"),
-            "Trace": json.dumps(score.get("trace")) if score.get("trace") else None,
-            "ProjectId": score.get("projectId"),
-        }
-        for score in scores_data
-    ]
-
-    return pd.DataFrame(scores_dicts) if scores_dicts else pd.DataFrame()
+    score_frames = list(iter_score_frames(start_from_date, end_date, spill=True))
+
+    utils_langfuse.log_connection_stats()
+    scores = schemas.concat_frames(score_frames)
+    schemas.log_memory_usage(scores, "scores")
+    return utils_handoff.hand_over(scores, "ai_tools_fetch_scores")
 
 
 @test
@@ -46,6 +89,6 @@ def test_output(output, *args) -> None:
 if __name__ == "__main__":
     # this is only for testing as a script locally, mage uses decorators to run the code
     logger.debug("running __main__")
-    scores_df = load_scores()
-    scores_df.to_pickle("scores.pkl")
+    scores_df = utils_handoff.take_over(load_scores())
+    utils_handoff.write_frame(scores_df, "scores.arrow")
     logger.debug(scores_df)
@@ -1,8 +1,18 @@
-import json
+from collections.abc import Iterator
 
 import pandas as pd
 
-from lodgify.utils.ai_tools import constants, utils_langfuse
+from lodgify.utils.ai_tools import (
+    constants,
+    schemas,
+    utils_backfill,
+    utils_handoff,
+    utils_langfuse,
+    utils_metrics,
+    utils_payloads,
+    utils_postgres,
+    utils_profiling,
+)
 from lodgify.utils.ai_tools.logger import logger
 
 if "data_loader" not in globals():
@@ -11,36 +21,68 @@ if "test" not in globals():
     from mage_ai.data_preparation.decorators import test
 
 
+def iter_trace_frames(start_from_date: str, end_date: str, spill: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Yields the traces of the window as DataFrames of constants.BATCH_SIZE rows,
+    so that the raw API data is only held in memory for one batch at a time.
+    """
+    for traces_data in utils_langfuse.iter_batches(
+        "traces",
+        start_from_date,
+        end_date,
+        constants.BATCH_SIZE,
+        concurrency=constants.PAGE_FETCH_CONCURRENCY,
+        spill=spill,
+    ):
+        yield utils_payloads.offload_payloads(schemas.build_frame(traces_data, schemas.TRACE_COLUMNS))
+
+
+def backfill_traces(**kwargs) -> pd.DataFrame:
+    """
+    Backfill mode, enabled with the runtime variable 'backfill_days': fetches and exports the traces of the
+    'backfill_days' before the execution date shard by shard (see utils_backfill.run_backfill),
+    so nothing is returned to the exporter block.
+    """
+    start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(int(kwargs["backfill_days"]), **kwargs)
+    utils_backfill.run_backfill(
+        "traces",
+        start_from_date,
+        end_date,
+        lambda shard_start, shard_end: utils_postgres.export_batches(
+            iter_trace_frames(shard_start, shard_end), schema_name="public", table_name="LangfuseTraces"
+        ),
+        shard=kwargs.get("backfill_shard", constants.BACKFILL_SHARD),
+    )
+    utils_langfuse.log_connection_stats()
+    return pd.DataFrame()
+
+
 @data_loader
+@utils_metrics.report_metrics("ai_tools_fetch_traces")
+@utils_profiling.profile_block("ai_tools_fetch_traces")
 def load_traces(*args, **kwargs):
+    """
+    Fetches the traces of the DAYS_BACK window (from the older of the traces and observations watermarks with
+    constants.INCREMENTAL_SYNC).
+    The batches are concatenated into a single DataFrame for the exporter, see utils_handoff.hand_over.
+    """
     logger.info(f"Run params {args=}, {kwargs=}")
+    if kwargs.get("backfill_days"):
+        return backfill_traces(**kwargs)
     start_from_date, end_date = utils_langfuse.calculate_start_and_end_dates(constants.DAYS_BACK, **kwargs)
+    if constants.INCREMENTAL_SYNC and not constants.REPLACE_WINDOW:
+        # the observations are only fetched for the loaded traces, so the traces are loaded from the observations
+        # watermark while it is behind, eg after a failed export of the observations, whose traces are fetched again
+        watermarks = [utils_postgres.get_watermark(entity) for entity in ("traces", "observations")]
+        watermark = None if None in watermarks else min(watermarks)
+        start_from_date = utils_langfuse.apply_watermark(start_from_date, end_date, watermark)
     logger.info(f"Fetching data {start_from_date=}, {end_date=}")
-    traces_data = utils_langfuse.fetch_all_pages("traces", start_from_date, end_date)
-
-    traces_dicts = [
-        {
-            "Id": trace["id"],
-            "Timestamp": trace["timestamp"],
-            "Name": trace.get("name"),
-            "Input": json.dumps(trace.get("input")) if trace["input"] else None,
-            "Output": json.dumps(trace.get("output")) if trace["output"] else None,
-            "SessionId": trace.get("sessionId"),
-            "Release": trace.get("release"),
-            "Version": trace.get("version"),
-            "UserId": trace.get("userId"),
-            "Metadata": json.dumps(trace["metadata"]) if trace["metadata"] else None,
-            "Tags": json.dumps(trace["tags"]) if trace["tags"] else None,
-            "Public": trace.get("public"),
-            "HtmlPath": trace["htmlPath"],
-            "TotalCost": trace["totalCost"],
-            "Latency": trace["latency"],
-            "ProjectId": trace["projectId"],
-        }
-        for trace in traces_data
-    ]
-
-    return pd.DataFrame(traces_dicts) if traces_dicts else pd.DataFrame()
+    trace_frames = list(iter_trace_frames(start_from_date, end_date, spill=True))
+
+    utils_langfuse.log_connection_stats()
+    traces = schemas.concat_frames(trace_frames)
+    schemas.log_memory_usage(traces, "traces")
+    return utils_handoff.hand_over(traces, "ai_tools_fetch_traces")
 
 
 @test
@@ -0,0 +1,99 @@
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from lodgify.utils.ai_assistant import constants, utils_files, utils_metrics
+from lodgify.utils.ai_assistant.logger import logger
+
+# key of the reference that a loader returns instead of its DataFrame
+HANDOFF_PATH_KEY = "handoff_path"
+
+
+def _types_mapper(arrow_type: pa.DataType) -> pd.ArrowDtype | None:
+    # the Arrow-backed columns of schemas.build_frame stay Arrow-backed (without a copy),
+    # pandas restores the categorical and timestamp columns itself
+    if pa.types.is_dictionary(arrow_type) or pa.types.is_timestamp(arrow_type):
+        return None
+    return pd.ArrowDtype(arrow_type)
+
+
+def write_frame(data: pd.DataFrame, path: str | Path) -> None:
+    """
+    Writes the DataFrame to an Arrow IPC (Feather v2) file, compressed with constants.HANDOFF_COMPRESSION.
+    """
+    with utils_files.atomic_path(Path(path)) as tmp_path:
+        feather.write_feather(data, tmp_path, compression=constants.HANDOFF_COMPRESSION)
+
+
+def read_frame(path: str | Path) -> pd.DataFrame:
+    """
+    Reads a DataFrame written by write_frame, memory-mapped: uncompressed columns are used straight from the
+    page cache, and only the columns being decompressed need memory of their own.
+    """
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=_types_mapper)
+
+
+def _remove_expired(handoff_dir: Path) -> None:
+    expired_before = (datetime.now(timezone.utc) - constants.HANDOFF_RETENTION).timestamp()
+    for path in handoff_dir.glob("*.arrow"):
+        if path.stat().st_mtime < expired_before:
+            path.unlink(missing_ok=True)
+            logger.debug(f"Removed the expired handoff file {path}")
+
+
+def hand_over(data: pd.DataFrame, block: str) -> pd.DataFrame | dict[str, Any]:
+    """
+    With constants.HANDOFF_FORMAT "arrow", writes the output of the block to
+    <variables dir>/langfuse_handoff/<block>/ and returns a reference to it, which Mage stores instead of the
+    DataFrame. The downstream blocks get the DataFrame back with take_over.
+    Empty outputs are returned as they are, and so are the ones that Arrow cannot write: the untyped columns
+    that schemas.build_frame keeps for unexpected values can mix types (eg str and int).
+    Either way the output is a whole DataFrame, so the memory of the loaders that return one grows with their
+    window, unlike their backfill mode and the pipelined loader, which export batch by batch.
+    """
+    if constants.HANDOFF_FORMAT != "arrow" or data.empty:
+        return data
+    from mage_ai.settings.repo import get_variables_dir
+
+    handoff_dir = Path(get_variables_dir()) / "langfuse_handoff" / block
+    handoff_dir.mkdir(parents=True, exist_ok=True)
+    _remove_expired(handoff_dir)
+
+    path = handoff_dir / f"{uuid.uuid4().hex}.arrow"
+    started_at = time.perf_counter()
+    try:
+        write_frame(data, path)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as error:
+        logger.warning(f"Not handing over the output of {block} in a file, Arrow cannot write it: {error}")
+        return data
+    elapsed = time.perf_counter() - started_at
+    size = path.stat().st_size
+    utils_metrics.increment("langfuse_handoff_seconds_total", elapsed, operation="write")
+    utils_metrics.increment("langfuse_handoff_bytes_total", size, operation="write")
+    logger.info(f"Handing over {len(data)} rows in {path} ({size / 2**20:.1f} MiB, written in {elapsed:.1f}s)")
+    return {HANDOFF_PATH_KEY: str(path), "rows": len(data)}
+
+
+def take_over(data: pd.DataFrame | dict[str, Any]) -> pd.DataFrame:
+    """
+    Returns the DataFrame handed over by an upstream block, see hand_over.
+    """
+    if not isinstance(data, dict) or HANDOFF_PATH_KEY not in data:
+        return data
+    started_at = time.perf_counter()
+    frame = read_frame(data[HANDOFF_PATH_KEY])
+    elapsed = time.perf_counter() - started_at
+    utils_metrics.increment("langfuse_handoff_seconds_total", elapsed, operation="read")
+    utils_metrics.increment(
+        "langfuse_handoff_bytes_total", Path(data[HANDOFF_PATH_KEY]).stat().st_size, operation="read"
+    )
+    logger.info(f"Took over {len(frame)} rows from {data[HANDOFF_PATH_KEY]} in {elapsed:.1f}s")
+    return frame
@@ -0,0 +1,103 @@
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from lodgify.utils.ai_assistant import constants, utils_partitions
+from lodgify.utils.ai_assistant.logger import logger
+
+
+def index_name(table_name: str, columns: tuple[str, ...]) -> str:
+    return f"{table_name}_{'_'.join(columns)}_idx"
+
+
+def _get_indexes(cursor, schema_name: str, table_name: str) -> dict[str, bool]:
+    """
+    Returns whether every index of the table is valid, a failed CREATE INDEX CONCURRENTLY leaves an invalid one.
+    """
+    cursor.execute(
+        "SELECT index.relname, pg_index.indisvalid FROM pg_index JOIN pg_class AS index ON index.oid = indexrelid "
+        "WHERE indrelid = to_regclass(%s)",
+        (sql.Identifier(schema_name, table_name).as_string(cursor),),
+    )
+    return dict(cursor.fetchall())
+
+
+def lock_indexes(cursor, schema_name: str, table_name: str, wait: bool = True) -> bool:
+    """
+    Takes the session advisory lock of the indexes of the table, held by whoever builds or defers them.
+    Without wait, returns at once whether the lock was free.
+    """
+    function = "pg_advisory_lock" if wait else "pg_try_advisory_lock"
+    cursor.execute(f"SELECT {function}(hashtext(%s))", (f"indexes {schema_name}.{table_name}",))
+    return wait or cursor.fetchone()[0]
+
+
+def unlock_indexes(cursor, schema_name: str, table_name: str) -> None:
+    cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (f"indexes {schema_name}.{table_name}",))
+
+
+def _concurrently(cursor, schema_name: str, table_name: str) -> sql.Composable:
+    # postgres cannot build or drop the indexes of a partitioned table concurrently
+    if utils_partitions.is_partitioned(cursor, schema_name, table_name):
+        return sql.SQL("")
+    return sql.SQL("CONCURRENTLY")
+
+
+def build_missing_indexes(cursor, schema_name: str, table_name: str) -> None:
+    """
+    Creates the indexes of constants.SECONDARY_INDEXES that the table does not have (or only as invalid ones).
+    The cursor must be in autocommit mode: the indexes are built with CREATE INDEX CONCURRENTLY, which does not block
+    the writes to the table. Postgres cannot do that on a partitioned table, whose indexes are built with a plain
+    CREATE INDEX (blocking the writes meanwhile), and then created with every new partition.
+    An index that cannot be built is logged and skipped.
+    """
+    existing_indexes = _get_indexes(cursor, schema_name, table_name)
+    concurrently = _concurrently(cursor, schema_name, table_name)
+    cursor.execute("SET maintenance_work_mem = %s", (constants.INDEX_MAINTENANCE_WORK_MEM,))
+    try:
+        for columns in constants.SECONDARY_INDEXES.get(table_name, ()):
+            name = index_name(table_name, columns)
+            if existing_indexes.get(name):
+                continue
+            started_at = time.perf_counter()
+            try:
+                if name in existing_indexes:
+                    logger.warning(f"Rebuilding the invalid index {name}")
+                    cursor.execute(
+                        sql.SQL("DROP INDEX {} IF EXISTS {}").format(concurrently, sql.Identifier(schema_name, name))
+                    )
+                cursor.execute(
+                    sql.SQL("CREATE INDEX {} IF NOT EXISTS {} ON {} ({})").format(
+                        concurrently,
+                        sql.Identifier(name),
+                        sql.Identifier(schema_name, table_name),
+                        sql.SQL(", ").join(map(sql.Identifier, columns)),
+                    )
+                )
+            except psycopg2.Error:
+                logger.exception(f"Could not build the index {name}")
+                continue
+            logger.info(f"Built the index {name} in {time.perf_counter() - started_at:.1f}s")
+    finally:
+        cursor.execute("RESET maintenance_work_mem")
+
+
+def drop_secondary_indexes(cursor, schema_name: str, table_name: str) -> list[str]:
+    """
+    Drops the indexes of constants.SECONDARY_INDEXES of the table, before a bulk load, with the cursor in autocommit
+    mode. The unique index on "Id" (or the primary key) is kept, the upserts need it. Returns the dropped indexes.
+    """
+    existing_indexes = _get_indexes(cursor, schema_name, table_name)
+    concurrently = _concurrently(cursor, schema_name, table_name)
+    dropped_indexes = []
+    for columns in constants.SECONDARY_INDEXES.get(table_name, ()):
+        name = index_name(table_name, columns)
+        if name in existing_indexes:
+            cursor.execute(
+                sql.SQL("DROP INDEX {} IF EXISTS {}").format(concurrently, sql.Identifier(schema_name, name))
+            )
+            dropped_indexes.append(name)
+    if dropped_indexes:
+        logger.info(f"Dropped the indexes {dropped_indexes} of {table_name} for the bulk load")
+    return dropped_indexes
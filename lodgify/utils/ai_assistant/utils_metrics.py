@@ -0,0 +1,232 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from lodgify.utils.ai_assistant import constants, utils_files
+from lodgify.utils.ai_assistant.logger import logger
+
+# upper bounds (in seconds) of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_HELP = {
+    "langfuse_requests_total": "Langfuse API requests by endpoint and HTTP status (every retry attempt counts)",
+    "langfuse_request_duration_seconds": "Latency of the Langfuse API requests by endpoint",
+    "langfuse_request_retries_total": "Langfuse API requests retried after a failure (eg a 429) by endpoint",
+    "langfuse_response_bytes_total": "Bytes downloaded from the Langfuse API by endpoint",
+    "langfuse_pages_total": "Pages fetched by endpoint, from the API or from the spill of a previous attempt",
+    "langfuse_trace_detail_fallbacks_total": "Traces whose observations were paged because their detail lacked them",
+    "langfuse_rows_transformed_total": "API objects turned into DataFrame rows by entity",
+    "langfuse_transform_seconds_total": "Time spent turning API objects into DataFrames by entity",
+    "langfuse_export_rows_total": "Rows exported to postgres by table and result (inserted, updated, unchanged, replaced)",
+    "langfuse_export_seconds_total": "Time spent exporting to postgres by table and phase",
+    "langfuse_export_rows_per_second": "Rows per second of the latest export to postgres by table",
+    "langfuse_export_failures_total": "Failed exports to postgres by table",
+    "langfuse_fetch_concurrency": "Latest concurrency limit of the adaptive fetches by stage",
+    "langfuse_handoff_seconds_total": "Time spent writing and reading the outputs handed over between blocks",
+    "langfuse_handoff_bytes_total": "Bytes of the outputs handed over between blocks, written and read",
+    "langfuse_stage_seconds_total": "Wall time spent in the stages of the block",
+    "langfuse_block_duration_seconds": "Wall time of the block run",
+    "langfuse_block_success": "1 when the block run succeeded, 0 when it failed",
+    "langfuse_block_last_run_timestamp_seconds": "Unix time at which the block run finished",
+}
+
+_Key = tuple[str, tuple[tuple[str, str], ...]]
+
+
+@dataclass
+class _Histogram:
+    bucket_counts: list[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+    total: float = 0
+    count: int = 0
+
+
+# the registry is process-wide and shared by all the threads of a block, write_summary resets it
+_lock = threading.Lock()
+_counters: dict[_Key, float] = {}
+_gauges: dict[_Key, float] = {}
+_histograms: dict[_Key, _Histogram] = {}
+
+
+def _key(name: str, labels: dict[str, Any]) -> _Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """
+    Adds the value to the histogram, with the LATENCY_BUCKETS.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.setdefault(key, _Histogram())
+        histogram.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram.total += value
+        histogram.count += 1
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    """
+    Adds the wall time of the stage to langfuse_stage_seconds_total, also when it fails.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        increment("langfuse_stage_seconds_total", time.perf_counter() - started_at, stage=stage)
+
+
+def snapshot() -> dict[str, list[dict[str, Any]]]:
+    """
+    Returns the current metrics, with cumulative histogram buckets like Prometheus.
+    """
+    with _lock:
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value} for (name, labels), value in _counters.items()
+        ]
+        gauges = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in _gauges.items()]
+        histograms = []
+        for (name, labels), histogram in _histograms.items():
+            cumulative = 0
+            buckets = {}
+            for upper_bound, bucket_count in zip(
+                (*map(str, LATENCY_BUCKETS), "+Inf"), histogram.bucket_counts, strict=True
+            ):
+                cumulative += bucket_count
+                buckets[upper_bound] = cumulative
+            histograms.append(
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": buckets,
+                    "sum": histogram.total,
+                    "count": histogram.count,
+                }
+            )
+    return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in labels.items()) + "}"
+
+
+def render_prometheus(summary: dict[str, Any]) -> str:
+    """
+    Renders the summary in the Prometheus text format, every series labelled with the block.
+    """
+    block = {"block": summary["block"]}
+    samples: dict[str, tuple[str, list[str]]] = {}
+
+    def add(name: str, metric_type: str, sample: str) -> None:
+        samples.setdefault(name, (metric_type, []))[1].append(sample)
+
+    for counter in summary["counters"]:
+        labels = _format_labels(block | counter["labels"])
+        add(counter["name"], "counter", f"{counter['name']}{labels} {counter['value']}")
+    for gauge in summary["gauges"]:
+        labels = _format_labels(block | gauge["labels"])
+        add(gauge["name"], "gauge", f"{gauge['name']}{labels} {gauge['value']}")
+    for histogram in summary["histograms"]:
+        name = histogram["name"]
+        for upper_bound, count in histogram["buckets"].items():
+            add(
+                name,
+                "histogram",
+                f"{name}_bucket{_format_labels(block | histogram['labels'] | {'le': upper_bound})} {count}",
+            )
+        labels = _format_labels(block | histogram["labels"])
+        add(name, "histogram", f"{name}_sum{labels} {histogram['sum']}")
+        add(name, "histogram", f"{name}_count{labels} {histogram['count']}")
+
+    lines = []
+    for name, (metric_type, metric_samples) in samples.items():
+        if name in _HELP:
+            lines.append(f"# HELP {name} {_HELP[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(metric_samples)
+    return "\n".join(lines) + "\n"
+
+
+def write_summary(block: str, succeeded: bool, duration_seconds: float) -> None:
+    """
+    Writes the metrics collected since the previous summary to constants.METRICS_DIR as <block>.json
+    and <block>.prom (Prometheus textfile), then resets them. Never fails the block.
+    """
+    finished_at = datetime.now(timezone.utc)
+    set_gauge("langfuse_block_duration_seconds", duration_seconds)
+    set_gauge("langfuse_block_success", int(succeeded))
+    set_gauge("langfuse_block_last_run_timestamp_seconds", finished_at.timestamp())
+    summary = {
+        "block": block,
+        "status": "succeeded" if succeeded else "failed",
+        "finished_at": finished_at.isoformat(),
+        "duration_seconds": duration_seconds,
+        **snapshot(),
+    }
+    reset()
+    try:
+        metrics_dir = Path(constants.METRICS_DIR)
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        # the textfile collector may read at any time
+        for path, content in (
+            (metrics_dir / f"{block}.json", json.dumps(summary, indent=2)),
+            (metrics_dir / f"{block}.prom", render_prometheus(summary)),
+        ):
+            with utils_files.atomic_path(path) as tmp_path:
+                tmp_path.write_text(content)
+    except OSError:
+        logger.exception(f"Could not write the run metrics of {block} to {constants.METRICS_DIR}")
+        return
+    logger.info(f"Wrote the run metrics of {block} to {metrics_dir}")
+
+
+def report_metrics(block: str) -> Callable[[Callable], Callable]:
+    """
+    Decorates a block function to write the summary of its run metrics when it returns or fails.
+    Blocks running at the same time in one process share the registry, so their summaries would mix.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) -> Any:
+            started_at = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                write_summary(block, succeeded=False, duration_seconds=time.perf_counter() - started_at)
+                raise
+            write_summary(block, succeeded=True, duration_seconds=time.perf_counter() - started_at)
+            return result
+
+        return wrapper
+
+    return decorator
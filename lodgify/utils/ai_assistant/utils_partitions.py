@@ -0,0 +1,129 @@
+import re
+from collections.abc import Iterable
+from datetime import date, datetime, time, timedelta, timezone
+
+from psycopg2 import sql
+
+from lodgify.utils.ai_assistant.logger import logger
+
+
+def _bounds(day: date) -> tuple[datetime, datetime]:
+    start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def partition_name(table_name: str, day: date) -> str:
+    return f"{table_name}_{day:%Y%m%d}"
+
+
+def day_of(column: str) -> sql.Composable:
+    """
+    Returns the expression of the UTC day of the column (a timestamptz, or its text), the partition of its rows.
+    """
+    return sql.SQL("({}::timestamptz AT TIME ZONE 'UTC')::date").format(sql.Identifier(column))
+
+
+def is_partitioned(cursor, schema_name: str, table_name: str) -> bool:
+    cursor.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)",
+        (sql.Identifier(schema_name, table_name).as_string(cursor),),
+    )
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def get_partition_days(cursor, schema_name: str, table_name: str) -> set[date]:
+    """
+    Returns the days of the existing partitions of the table, from their names (see partition_name).
+    """
+    cursor.execute(
+        "SELECT partition.relname FROM pg_inherits JOIN pg_class AS partition ON partition.oid = inhrelid "
+        "WHERE inhparent = to_regclass(%s)",
+        (sql.Identifier(schema_name, table_name).as_string(cursor),),
+    )
+    name_pattern = re.compile(rf"{re.escape(table_name)}_(\d{{4}})(\d{{2}})(\d{{2}})")
+    return {date(*map(int, match.groups())) for (name,) in cursor.fetchall() if (match := name_pattern.fullmatch(name))}
+
+
+def create_partitions(cursor, schema_name: str, table_name: str, days: Iterable[date]) -> None:
+    """
+    Creates the daily partitions of the table that do not exist yet, postgres then routes the rows into them.
+    """
+    for day in sorted(set(days) - get_partition_days(cursor, schema_name, table_name)):
+        start, end = _bounds(day)
+        cursor.execute(
+            sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})").format(
+                sql.Identifier(schema_name, partition_name(table_name, day)),
+                sql.Identifier(schema_name, table_name),
+                sql.Literal(start),
+                sql.Literal(end),
+            )
+        )
+        logger.info(f"Created the partition of {day} of {table_name}")
+
+
+def partition_table(cursor, schema_name: str, table_name: str, column: str) -> None:
+    """
+    Converts the table into a table partitioned by day on the column (a timestamptz), with the primary key
+    ("Id", column): the rows are copied into the daily partitions of a new table with the same columns,
+    which replaces the old one. Fails when other objects (eg views) depend on the table.
+    """
+    unpartitioned_name = f"{table_name}_unpartitioned"
+    target = sql.Identifier(schema_name, table_name)
+    unpartitioned = sql.Identifier(schema_name, unpartitioned_name)
+    logger.warning(f"Converting {table_name} into a table partitioned by day on {column}")
+    cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(target, sql.Identifier(unpartitioned_name)))
+    cursor.execute(
+        sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE ({})").format(
+            target, unpartitioned, sql.Identifier(column)
+        )
+    )
+    cursor.execute(sql.SQL("SELECT DISTINCT {} FROM {}").format(day_of(column), unpartitioned))
+    create_partitions(cursor, schema_name, table_name, [day for (day,) in cursor.fetchall()])
+    cursor.execute(sql.SQL("INSERT INTO {} SELECT * FROM {}").format(target, unpartitioned))
+    logger.info(f"Copied {cursor.rowcount} rows into the partitions of {table_name}")
+    cursor.execute(sql.SQL("DROP TABLE {}").format(unpartitioned))
+    # built after the copy, which is faster than maintaining it row by row
+    cursor.execute(sql.SQL('ALTER TABLE {} ADD PRIMARY KEY ("Id", {})').format(target, sql.Identifier(column)))
+
+
+def replace_partition(
+    cursor, schema_name: str, table_name: str, column: str, day: date, columns: list[str], source: sql.Composable
+) -> int:
+    """
+    Loads the rows of the source query (with the given columns) into a new table, and swaps it in for the partition
+    of the day. Within the transaction of the cursor, so readers see either the old or the new partition.
+    Returns the number of loaded rows.
+    """
+    start, end = _bounds(day)
+    name = partition_name(table_name, day)
+    target = sql.Identifier(schema_name, table_name)
+    partition = sql.Identifier(schema_name, name)
+    fresh_partition = sql.Identifier(schema_name, f"{name}_new")
+    bounds = sql.Identifier(f"{name}_bounds")
+
+    cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(fresh_partition, target))
+    cursor.execute(
+        sql.SQL("INSERT INTO {} ({}) {}").format(
+            fresh_partition, sql.SQL(", ").join(map(sql.Identifier, columns)), source
+        )
+    )
+    loaded_rows = cursor.rowcount
+    # lets ATTACH PARTITION trust the bounds instead of scanning the rows to check them
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK ({column} >= {} AND {column} < {})").format(
+            fresh_partition, bounds, sql.Literal(start), sql.Literal(end), column=sql.Identifier(column)
+        )
+    )
+    if day in get_partition_days(cursor, schema_name, table_name):
+        cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(target, partition))
+        cursor.execute(sql.SQL("DROP TABLE {}").format(partition))
+    cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(fresh_partition, sql.Identifier(name)))
+    cursor.execute(
+        sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+            target, partition, sql.Literal(start), sql.Literal(end)
+        )
+    )
+    cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(partition, bounds))
+    logger.info(f"Replaced the partition of {day} of {table_name} with {loaded_rows} rows")
+    return loaded_rows
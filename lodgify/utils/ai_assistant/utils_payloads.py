@@ -0,0 +1,94 @@
+import hashlib
+
+import pandas as pd
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from lodgify.utils.ai_assistant import constants, utils_postgres
+from lodgify.utils.ai_assistant.logger import logger
+
+# hashes of the payloads this process already wrote, so that a repeated payload (eg. a system prompt)
+# is only sent to postgres once, reset when it gets too large
+_written_hashes: set[str] = set()
+_MAX_WRITTEN_HASHES = 100_000
+
+
+def payload_hash(payload: str) -> str:
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def offload_payloads(data: pd.DataFrame, schema_name: str = "public") -> pd.DataFrame:
+    """
+    With constants.PAYLOAD_OFFLOAD, moves the payloads (constants.PAYLOAD_COLUMNS) longer than
+    constants.PAYLOAD_OFFLOAD_THRESHOLD characters to the content-addressed constants.PAYLOADS_TABLE.
+    Every distinct payload is stored once, keyed by its hash. The rows keep the hash in the '<column>Hash' column
+    and None in the payload column, smaller payloads stay inline.
+    """
+    columns = [column for column in constants.PAYLOAD_COLUMNS if column in data.columns]
+    if not constants.PAYLOAD_OFFLOAD or not columns:
+        return data
+
+    payloads = {}
+    offloaded = {}
+    for column in columns:
+        inline_values = []
+        hashes = []
+        for value in data[column].astype(object):
+            if isinstance(value, str) and len(value) > constants.PAYLOAD_OFFLOAD_THRESHOLD:
+                value_hash = payload_hash(value)
+                payloads.setdefault(value_hash, value)
+                inline_values.append(None)
+                hashes.append(value_hash)
+            else:
+                inline_values.append(value)
+                hashes.append(None)
+        offloaded[column] = pd.array(inline_values, dtype=data[column].dtype)
+        offloaded[f"{column}Hash"] = pd.array(hashes, dtype=data[column].dtype)
+
+    _write_payloads(payloads, schema_name)
+    return data.assign(**offloaded)
+
+
+def _ensure_payloads_table(cursor, payloads_table: sql.Identifier) -> None:
+    # postgres compresses the payloads itself (TOAST), so they stay readable with a plain join on "Hash"
+    cursor.execute(
+        sql.SQL(
+            'CREATE TABLE IF NOT EXISTS {} ("Hash" text PRIMARY KEY, "Payload" text NOT NULL, "Size" integer NOT NULL, '
+            '"CreatedAt" timestamptz NOT NULL DEFAULT now())'
+        ).format(payloads_table)
+    )
+
+
+def _remember_written(payloads: list[tuple[str, str, int]]) -> None:
+    if len(_written_hashes) > _MAX_WRITTEN_HASHES:
+        _written_hashes.clear()
+    _written_hashes.update(value_hash for value_hash, _, _ in payloads)
+
+
+def _write_payloads(payloads: dict[str, str], schema_name: str) -> None:
+    """
+    Inserts the payloads that are not in the payloads table yet.
+    Fails the block otherwise, rows must not reference a payload that was not stored.
+    During an export (eg of the batches of the pipelined loader or of a backfill), they are written in its
+    transaction, on the connection it holds, see utils_postgres.connection.
+    """
+    new_payloads = [
+        (value_hash, payload, len(payload))
+        for value_hash, payload in payloads.items()
+        if value_hash not in _written_hashes
+    ]
+    if not new_payloads:
+        return
+    payloads_table = sql.Identifier(schema_name, constants.PAYLOADS_TABLE)
+    with utils_postgres.connection() as conn, conn.cursor() as cursor:
+        _ensure_payloads_table(cursor, payloads_table)
+        execute_values(
+            cursor,
+            sql.SQL('INSERT INTO {} ("Hash", "Payload", "Size") VALUES %s ON CONFLICT ("Hash") DO NOTHING').format(
+                payloads_table
+            ),
+            new_payloads,
+        )
+        # only once committed, a rolled back export must write them again
+        utils_postgres.on_commit(lambda: _remember_written(new_payloads))
+    logger.debug(f"Offloaded {len(new_payloads)} new payloads to {constants.PAYLOADS_TABLE}")
@@ -0,0 +1,149 @@
+import cProfile
+import functools
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from lodgify.utils.ai_assistant import constants
+from lodgify.utils.ai_assistant.logger import logger
+
+# frames kept per tracemalloc allocation, more makes the tracing slower
+_TRACEMALLOC_FRAMES = 10
+_TOP_ENTRIES = 40
+
+
+class StackSampler:
+    """
+    Samples the stacks of all the threads from a background thread while in the context.
+    cProfile only sees the thread it runs in, this also shows where the fetch workers spend their time
+    (eg waiting on HTTP responses or on the rate limiter).
+    """
+
+    def __init__(self, interval_seconds: float) -> None:
+        self.interval_seconds = interval_seconds
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiling-sampler", daemon=True)
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval_seconds):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, top_frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                frame = top_frame
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed_stacks(self) -> str:
+        """
+        Returns the samples in the collapsed stack format of flamegraph.pl, which speedscope also opens.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def __enter__(self) -> "StackSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def is_enabled(block: str) -> bool:
+    blocks = {name.strip() for name in constants.PROFILE_BLOCKS.split(",")}
+    return "all" in blocks or block in blocks
+
+
+def _write_artifacts(
+    profile_dir: Path,
+    profiler: cProfile.Profile,
+    sampler: StackSampler,
+    snapshot: tracemalloc.Snapshot,
+    traced_memory: tuple[int, int],
+) -> None:
+    profile_dir.mkdir(parents=True, exist_ok=True)
+
+    profiler.dump_stats(profile_dir / "cpu.prof")
+    cpu_report = io.StringIO()
+    pstats.Stats(profiler, stream=cpu_report).sort_stats("cumulative").print_stats(_TOP_ENTRIES)
+    (profile_dir / "cpu.txt").write_text(cpu_report.getvalue())
+
+    (profile_dir / "stacks.txt").write_text(sampler.collapsed_stacks())
+
+    snapshot.dump(str(profile_dir / "memory.snapshot"))
+    top_lines = snapshot.statistics("lineno")[:_TOP_ENTRIES]
+    (profile_dir / "memory.txt").write_text(
+        f"Traced memory at the end: {traced_memory[0] / 2**20:.1f} MiB, peak: {traced_memory[1] / 2**20:.1f} MiB\n\n"
+        + "".join(f"{stat}\n" for stat in top_lines)
+    )
+
+
+@contextmanager
+def profile(block: str) -> Iterator[None]:
+    """
+    Profiles the code in the context, and writes to <variables dir>/profiles/<block>/<UTC time>/:
+    - cpu.prof: cProfile of the calling thread, for `python -m pstats` or snakeviz, and cpu.txt with its top entries
+    - stacks.txt: sampled stacks of all the threads, in the collapsed format of flamegraph.pl and speedscope
+    - memory.snapshot: tracemalloc snapshot at the end, for tracemalloc.Snapshot.load,
+      and memory.txt with the peak and the top allocating lines
+    """
+    from mage_ai.settings.repo import get_variables_dir
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(_TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    started_at = datetime.now(timezone.utc)
+    try:
+        with StackSampler(constants.PROFILE_SAMPLING_INTERVAL) as sampler:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        traced_memory = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+        profile_dir = Path(get_variables_dir()) / "profiles" / block / started_at.strftime("%Y%m%dT%H%M%SZ")
+        try:
+            _write_artifacts(profile_dir, profiler, sampler, snapshot, traced_memory)
+            logger.info(f"Wrote the profile of {block} to {profile_dir}")
+        except OSError:
+            logger.exception(f"Could not write the profile of {block} to {profile_dir}")
+
+
+def profile_block(block: str) -> Callable[[Callable], Callable]:
+    """
+    Decorates a block function to profile its runs when the block is in constants.PROFILE_BLOCKS
+    (environment variable LANGFUSE_PROFILE), see profile.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) -> Any:
+            if not is_enabled(block):
+                return function(*args, **kwargs)
+            with profile(block):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,7 +1,114 @@
 import os
+import tempfile
+from datetime import timedelta
 
 DAYS_BACK = 2
 
+# number of pages of traces/scores fetched in parallel, see utils_langfuse.fetch_all_pages
+# not too high to respect API limits: https://langfuse.com/faq/all/api-limits
+PAGE_FETCH_CONCURRENCY = 4
+# number of traces whose observations are fetched in parallel at the start, then adapted at runtime between
+# OBSERVATION_FETCH_MIN_WORKERS and OBSERVATION_FETCH_MAX_WORKERS (the HTTP connection pool is sized from them,
+# see utils_langfuse.get_pool_size)
+# from the latency and the 429s, see utils_langfuse.AdaptiveConcurrency
+OBSERVATION_FETCH_WORKERS = 8
+OBSERVATION_FETCH_MIN_WORKERS = 2
+OBSERVATION_FETCH_MAX_WORKERS = 32
+# the concurrency is halved when the median latency of the fetches rises above this multiple of the lowest one
+FETCH_LATENCY_TOLERANCE = 2.0
+# "window": page through all the observations of the time window at once and group them by trace locally,
+# "trace": page through the observations of every trace separately (one request chain per trace)
+OBSERVATION_FETCH_MODE = "window"
+# how the observations of a single trace are fetched (in "trace" mode, or for the traces missing from the window):
+# "pages": /observations?traceId=..., "trace_detail": embedded in /traces/{id}, see utils_langfuse.fetch_trace_observations
+PER_TRACE_FETCH_METHOD = "pages"
+# trace ids buffered between the trace pager and the observation workers of the pipelined loader
+PIPELINE_QUEUE_SIZE = 1000
+# upper bound of requests per second for all the Langfuse calls of the process, see utils_langfuse.rate_limiter
+# kept just under the limit of 1000 requests per minute: https://langfuse.com/faq/all/api-limits
+LANGFUSE_REQUESTS_PER_SECOND = 15
+# fetched pages are spilled here until the data was exported, so that a retried block run can resume, see utils_spill
+SPILL_DIR = os.path.join(tempfile.gettempdir(), "langfuse_spill", "ai_tools")
+# every block writes a summary of its run metrics here, as <block>.json and as a Prometheus textfile <block>.prom
+# (point the textfile collector of node_exporter to it), see utils_metrics
+METRICS_DIR = os.getenv("LANGFUSE_METRICS_DIR", os.path.join(tempfile.gettempdir(), "langfuse_metrics", "ai_tools"))
+# blocks to profile, "all" or comma-separated block names (eg "ai_tools_fetch_traces,ai_tools_save_traces"),
+# their profiles are written to the Mage variables directory, see utils_profiling
+PROFILE_BLOCKS = os.getenv("LANGFUSE_PROFILE", "")
+# seconds between two samples of the stacks of all the threads
+PROFILE_SAMPLING_INTERVAL = 0.01
+# "arrow": the loaders write their DataFrame to an Arrow IPC file in the Mage variables directory and hand over
+# a reference to it, which the downstream blocks read memory-mapped, "mage": the loaders return the DataFrame itself
+# (serialized by Mage), see utils_handoff
+HANDOFF_FORMAT = "arrow"
+# "zstd", "lz4" or "uncompressed" (larger files, but read without copying the data)
+HANDOFF_COMPRESSION = "zstd"
+# handoff files older than this are removed when a loader writes a new one
+HANDOFF_RETENTION = timedelta(days=2)
+# rows per batch when streaming from Langfuse and when writing to postgres
+BATCH_SIZE = 5000
+
+# fetch only from the latest exported timestamp (the watermark) minus the overlap, instead of the full DAYS_BACK window
+INCREMENTAL_SYNC = True
+# covers data that arrives in Langfuse with a delay
+WATERMARK_OVERLAP = timedelta(hours=2)
+# table in the target database with the watermark of every entity
+SYNC_STATE_TABLE = "LangfuseSyncState"
+# fetch observations only for the traces that are new or changed since their observations were last exported,
+# the traces that were checked are recorded in OBSERVATION_SYNC_TABLE (truncate it to re-fetch everything)
+SKIP_UNCHANGED_TRACES = True
+OBSERVATION_SYNC_TABLE = "LangfuseObservationSync"
+# traces not checked for this long are removed from OBSERVATION_SYNC_TABLE, they are out of the DAYS_BACK window
+OBSERVATION_SYNC_RETENTION = timedelta(days=7)
+# connections to the target database kept open by every process, shared by all the blocks it runs,
+# at least one per table exported at the same time (PARALLEL_EXPORT), and one more for the pipelined loader,
+# which reads the observation sync markers while its three exports hold theirs
+POSTGRES_POOL_SIZE = 4
+# the <package>_save_all exporter writes the traces, observations and scores at the same time, over separate connections
+PARALLEL_EXPORT = True
+# partition the traces, observations and scores tables by day on their time column (Timestamp or StartTime),
+# creating the partitions as rows arrive, an existing table is converted by its first export (its time column from text
+# to timestamptz first), see utils_partitions
+PARTITION_TABLES = False
+# with PARTITION_TABLES, replace the partitions of the days of the DAYS_BACK window with fresh ones loaded from the
+# fetched rows, instead of upserting them row by row. The loaders then fetch the full window (no watermark, no
+# skipping of unchanged traces), and rows outside of the window are still upserted
+REPLACE_WINDOW = False
+# "copy": COPY into an unlogged staging table and upsert from there with a single INSERT ... ON CONFLICT,
+# "mage": mage's Postgres.export (also used to create a table that does not exist yet)
+EXPORT_METHOD = "copy"
+# column with the hash of the content of every exported row, rows are only updated when it changes
+CONTENT_HASH_COLUMN = "ContentHash"
+
+# move the payloads (PAYLOAD_COLUMNS) longer than PAYLOAD_OFFLOAD_THRESHOLD characters to PAYLOADS_TABLE,
+# stored once per distinct content and keyed by its hash, the rows keep the hash in "<column>Hash", see utils_payloads
+PAYLOAD_OFFLOAD = False
+# postgres compresses values from about 2kB, so the offloaded payloads are stored compressed
+PAYLOAD_OFFLOAD_THRESHOLD = 2048
+PAYLOAD_COLUMNS = ("Input", "Output", "Metadata")
+PAYLOADS_TABLE = "LangfusePayloads"
+
+# backfills (runtime variable backfill_days) are split into shards of a "day" or an "hour",
+# BACKFILL_CONCURRENCY shards are fetched and exported at a time
+BACKFILL_SHARD = "day"
+BACKFILL_CONCURRENCY = 2
+# table in the target database with the completed shards of every backfill
+BACKFILL_CHECKPOINTS_TABLE = "LangfuseBackfillCheckpoints"
+# backfills with at least this much of their window still pending drop the SECONDARY_INDEXES of their table
+# while they load, and build them again once done, which is faster than maintaining them row by row.
+# A span rather than a number of shards, which would be reached by a few hours of hourly shards
+BACKFILL_DEFER_INDEXES_MIN_SPAN = timedelta(days=7)
+
+# secondary indexes of the target tables (besides the unique "Id"), as the columns of every index by table.
+# The exporters build the missing ones after their export, without blocking the writes, see utils_indexes
+SECONDARY_INDEXES = {
+    "LangfuseTraces": (("Timestamp",), ("SessionId",), ("UserId",)),
+    "LangfuseObservations": (("TraceId",), ("StartTime",), ("Model",)),
+    "LangfuseScores": (("TraceId",), ("Timestamp",)),
+}
+# maintenance_work_mem of the index builds, more memory sorts the rows in fewer passes
+INDEX_MAINTENANCE_WORK_MEM = "256MB"
+
 
 _CONFIG_MAPPER = {
     "live": {
@@ -0,0 +1,197 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import orjson
+import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
+
+from lodgify.utils.ai_tools import utils_metrics
+from lodgify.utils.ai_tools.logger import logger
+
+STRING = pa.string()
+# parsed by pandas into datetime64[ns, UTC], written back as the ISO 8601 text of the API, see format_timestamps
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+
+@dataclass(frozen=True)
+class Column:
+    """
+    Maps a field of the Langfuse API objects to a column of the loaded DataFrames.
+    'required' fields fail the load when missing, 'as_json' fields are serialized to a JSON string,
+    to None when empty if 'empty_as_null'. 'categorical' is for the columns with few distinct values,
+    which are then stored once per value instead of once per row. 'sort_json' lists are sorted before the
+    serialization, for the ones whose order the API does not keep.
+    """
+
+    name: str
+    source: str
+    dtype: pa.DataType = STRING
+    required: bool = False
+    as_json: bool = False
+    empty_as_null: bool = True
+    categorical: bool = False
+    sort_json: bool = False
+
+
+TRACE_COLUMNS = (
+    Column("Id", "id", required=True),
+    Column("Timestamp", "timestamp", TIMESTAMP, required=True),
+    Column("Name", "name", categorical=True),
+    Column("Input", "input", required=True, as_json=True),
+    Column("Output", "output", required=True, as_json=True),
+    Column("SessionId", "sessionId"),
+    Column("Release", "release", categorical=True),
+    Column("Version", "version"),
+    Column("UserId", "userId"),
+    Column("Metadata", "metadata", required=True, as_json=True),
+    Column("Tags", "tags", required=True, as_json=True),
+    Column("Public", "public", pa.bool_()),
+    Column("HtmlPath", "htmlPath", required=True),
+    Column("TotalCost", "totalCost", pa.float64(), required=True),
+    Column("Latency", "latency", pa.float64(), required=True),
+    Column("ProjectId", "projectId", required=True, categorical=True),
+    # the ids of the observations of the trace, so that its new observations change the trace row, see
+    # find_changed_traces in the observations loader
+    Column("ObservationIds", "observations", as_json=True, sort_json=True),
+)
+
+OBSERVATION_COLUMNS = (
+    Column("Id", "id", required=True),
+    Column("TraceId", "traceId", required=True),
+    Column("Type", "type", required=True, categorical=True),
+    Column("Name", "name", categorical=True),
+    Column("StartTime", "startTime", TIMESTAMP, required=True),
+    Column("EndTime", "endTime", TIMESTAMP),
+    Column("CompletionStartTime", "completionStartTime", TIMESTAMP),
+    Column("Model", "model", categorical=True),
+    Column("ModelParameters", "modelParameters", required=True, as_json=True),
+    Column("Input", "input", as_json=True),
+    Column("Version", "version"),
+    Column("Metadata", "metadata", as_json=True),
+    Column("Output", "output", as_json=True),
+    Column("Usage", "usage", as_json=True),
+    Column("Level", "level", required=True, categorical=True),
+    Column("StatusMessage", "statusMessage"),
+    Column("ParentObservationId", "parentObservationId"),
+    Column("PromptId", "promptId"),
+    Column("ModelId", "modelId"),
+    Column("InputPrice", "inputPrice", pa.float64()),
+    Column("OutputPrice", "outputPrice", pa.float64()),
+    Column("TotalPrice", "totalPrice", pa.float64()),
+    Column("CalculatedInputCost", "calculatedInputCost", pa.float64()),
+    Column("CalculatedOutputCost", "calculatedOutputCost", pa.float64()),
+    Column("CalculatedTotalCost", "calculatedTotalCost", pa.float64()),
+    Column("Latency", "latency", pa.float64()),
+    Column("TotalToken", "totalToken", pa.int64()),
+)
+
+SCORE_COLUMNS = (
+    Column("Id", "id", required=True),
+    Column("TraceId", "traceId", required=True),
+    Column("Name", "name", required=True, categorical=True),
+    Column("Value", "value", pa.float64(), required=True),
+    Column("Source", "source", categorical=True),
+    Column("ObservationId", "observationId"),
+    Column("Timestamp", "timestamp", TIMESTAMP, required=True),
+    Column("Comment", "comment"),
+    Column("StringValue", "stringValue"),
+    Column("DataType", "dataType", categorical=True),
+    Column("Trace", "trace", as_json=True),
+    Column("ProjectId", "projectId", categorical=True),
+)
+
+# the entity label of the run metrics of build_frame
+_ENTITIES = {TRACE_COLUMNS: "traces", OBSERVATION_COLUMNS: "observations", SCORE_COLUMNS: "scores"}
+
+
+def dumps(value: Any) -> str:
+    try:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+    except TypeError:  # eg. integers over 64 bits, that json handles
+        # formatted like orjson, so that a column never mixes both formats (nor their content hashes)
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _column_values(records: list[dict], column: Column) -> list:
+    if column.required:
+        values = [record[column.source] for record in records]
+    else:
+        values = [record.get(column.source) for record in records]
+    if not column.as_json:
+        return values
+    if column.sort_json:
+        values = [sorted(value) if value else value for value in values]
+    if column.empty_as_null:
+        return [dumps(value) if value else None for value in values]
+    return [dumps(value) for value in values]
+
+
+def _to_array(values: list, column: Column) -> pd.api.extensions.ExtensionArray:
+    try:
+        if column.categorical:
+            return pd.Categorical(values)
+        if column.dtype == TIMESTAMP:
+            # vectorized parsing, the API sends ISO 8601 timestamps
+            return pd.to_datetime(pd.Series(values, dtype=object), utc=True, format="ISO8601").array
+        return pd.arrays.ArrowExtensionArray(pa.array(values, type=column.dtype, from_pandas=True))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError, TypeError):
+        logger.warning(f"Unexpected values for {column.name} ({column.dtype}), keeping the column untyped")
+        return pd.array(values, dtype=object)
+
+
+def build_frame(records: list[dict], columns: tuple[Column, ...]) -> pd.DataFrame:
+    """
+    Builds the DataFrame of the given API objects column by column, straight into Arrow-backed, categorical
+    or timestamp arrays, instead of going through an intermediate dict per row.
+    """
+    started_at = time.perf_counter()
+    data = pd.DataFrame(
+        {column.name: _to_array(_column_values(records, column), column) for column in columns},
+        index=pd.RangeIndex(len(records)),
+    )
+    entity = _ENTITIES.get(columns, "other")
+    utils_metrics.increment("langfuse_rows_transformed_total", len(records), entity=entity)
+    utils_metrics.increment("langfuse_transform_seconds_total", time.perf_counter() - started_at, entity=entity)
+    return data
+
+
+def format_timestamps(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Turns the timestamp columns back into the ISO 8601 text that the API sends, with milliseconds in UTC
+    (eg 2025-01-01T05:00:00.123Z), so that every write path stores the same text in the tables created from it.
+    """
+    formatted = {
+        column: (values.dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z").astype(object).where(values.notna(), None)
+        for column, values in data.items()
+        if isinstance(values.dtype, pd.DatetimeTZDtype)
+    }
+    return data.assign(**formatted) if formatted else data
+
+
+def concat_frames(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Same as pd.concat, but keeps the categorical columns categorical when the frames have different categories
+    (pd.concat falls back to object columns then).
+    """
+    if not frames:
+        return pd.DataFrame()
+    data = pd.concat(frames, ignore_index=True)
+    for column in data.columns:
+        if all(isinstance(frame.dtypes.get(column), pd.CategoricalDtype) for frame in frames):
+            data[column] = union_categoricals([frame[column] for frame in frames])
+    return data
+
+
+def log_memory_usage(data: pd.DataFrame, entity: str) -> None:
+    """
+    Logs the in-memory size of the loaded data per row, to size the Mage workers.
+    """
+    if data.empty:
+        return
+    memory_bytes = data.memory_usage(deep=True).sum()
+    logger.info(
+        f"Loaded {len(data)} {entity} using {memory_bytes / 2**20:.1f} MiB, {memory_bytes / len(data):.0f} bytes per row"
+    )
@@ -0,0 +1,99 @@
+import contextlib
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Literal
+
+from lodgify.utils.ai_tools import constants, utils_postgres
+from lodgify.utils.ai_tools.logger import logger
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+SHARD_SIZES = {"day": timedelta(days=1), "hour": timedelta(hours=1)}
+
+
+def split_into_shards(start_from_date: str, end_date: str, shard: Literal["day", "hour"]) -> list[tuple[str, str]]:
+    """
+    Splits the window (as returned by utils_langfuse.calculate_start_and_end_dates) into consecutive shards
+    of a day or an hour. The last shard ends at 'end_date'.
+    """
+    shard_size = SHARD_SIZES[shard]
+    shard_start = datetime.strptime(start_from_date, "%Y-%m-%dT%H:%M:%S%z")
+    window_end = datetime.strptime(end_date, "%Y-%m-%dT%H:%M:%S%z")
+    shards = []
+    while shard_start < window_end:
+        shard_end = min(shard_start + shard_size, window_end)
+        shards.append((shard_start.strftime(DATE_FORMAT), shard_end.strftime(DATE_FORMAT)))
+        shard_start = shard_end
+    return shards
+
+
+def get_span(shards: list[tuple[str, str]]) -> timedelta:
+    """
+    Returns the time covered by the shards (as returned by split_into_shards).
+    """
+    return sum(
+        (
+            datetime.strptime(shard_end, "%Y-%m-%dT%H:%M:%S%z") - datetime.strptime(shard_start, "%Y-%m-%dT%H:%M:%S%z")
+            for shard_start, shard_end in shards
+        ),
+        timedelta(),
+    )
+
+
+def run_backfill(
+    entity: str,
+    start_from_date: str,
+    end_date: str,
+    process_shard: Callable[[str, str], int],
+    shard: Literal["day", "hour"] = constants.BACKFILL_SHARD,
+    concurrency: int = constants.BACKFILL_CONCURRENCY,
+) -> int:
+    """
+    Runs 'process_shard' (fetching and exporting one shard, returning the number of rows) for every shard of the window,
+    'concurrency' shards at a time. Every completed shard is recorded in the checkpoint table and skipped
+    when the backfill is started again, so a failed backfill continues where it stopped.
+    When the pending shards cover at least constants.BACKFILL_DEFER_INDEXES_MIN_SPAN, the secondary indexes
+    of the table are dropped during the load and built again after it (see utils_postgres.deferred_indexes).
+    Raises after all the shards were attempted if any of them failed.
+    """
+    shards = split_into_shards(start_from_date, end_date, shard)
+    completed_shards = utils_postgres.get_completed_shards(entity)
+    pending_shards = [
+        (shard_start, shard_end)
+        for shard_start, shard_end in shards
+        if (shard_start, shard_end) not in completed_shards
+    ]
+    logger.info(
+        f"Backfilling {entity=} from {start_from_date} to {end_date}: {len(shards)} shards of a {shard}, "
+        f"{len(shards) - len(pending_shards)} already completed, {concurrency=}"
+    )
+
+    table_name = utils_postgres.ENTITY_TABLES[entity][0]
+    if get_span(pending_shards) >= constants.BACKFILL_DEFER_INDEXES_MIN_SPAN:
+        indexes = utils_postgres.deferred_indexes(table_name)
+    else:
+        indexes = contextlib.nullcontext()
+
+    total_rows = 0
+    failed_shards = []
+    with indexes, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        future_to_shard = {
+            executor.submit(process_shard, shard_start, shard_end): (shard_start, shard_end)
+            for shard_start, shard_end in pending_shards
+        }
+        for future in as_completed(future_to_shard):
+            shard_start, shard_end = future_to_shard[future]
+            try:
+                rows = future.result()
+            except Exception:
+                logger.exception(f"Backfill of {entity=} failed for shard {shard_start} - {shard_end}")
+                failed_shards.append((shard_start, shard_end))
+                continue
+            utils_postgres.mark_shard_completed(entity, shard_start, shard_end, rows)
+            total_rows += rows
+            logger.info(f"Backfilled {rows} rows of {entity=} for shard {shard_start} - {shard_end}")
+
+    if failed_shards:
+        raise RuntimeError(f"Backfill of {entity=} failed for {len(failed_shards)} shards, run it again to retry them")
+    logger.info(f"Backfill of {entity=} completed with {total_rows} rows")
+    return total_rows
@@ -0,0 +1,21 @@
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def atomic_path(path: Path) -> Iterator[Path]:
+    """
+    Yields a temporary path next to 'path' to write the file to, which replaces 'path' once the block succeeds,
+    so that a reader never sees a partial file (nor a crash leaves one behind). The temporary file is removed
+    when the block fails. Every writer gets its own temporary name, so that concurrent writers of the same file
+    never replace each other's partial files.
+    """
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        yield tmp_path
+        tmp_path.replace(path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
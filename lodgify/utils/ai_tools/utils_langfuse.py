@@ -1,29 +1,277 @@
+import functools
+import json
 import math
 import os
+import statistics
+import threading
+import time
 from base64 import b64encode
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from itertools import islice, pairwise
+from pathlib import Path
 from typing import Any, Literal
+from urllib.parse import quote
 
-import dotenv
 import requests
-from mage_ai.data_preparation.shared.secrets import get_secret_value
+from requests.adapters import HTTPAdapter
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
 
-from lodgify.utils.ai_tools import constants
+from lodgify.utils.ai_tools import constants, utils_metrics, utils_spill
 from lodgify.utils.ai_tools.logger import logger
 
-BASE_URL = "https://cloud.langfuse.com/api/public"
-
-secret_name = constants.get_config_mapper()["secret_name"]
-try:
-    credentials = get_secret_value(secret_name)
-except AttributeError:
-    # this happens when running this as a script (not in mage) on a local machine)
-    dotenv.load_dotenv()
-    credentials = os.getenv(secret_name)
-    assert credentials is not None, f"Credentials for {secret_name} not found"
+# can point to another Langfuse deployment, or to the local fake of the API in benchmarks/fake_langfuse.py
+BASE_URL = os.getenv("LANGFUSE_BASE_URL", "https://cloud.langfuse.com/api/public")
 
 attempt_count = 5
+# rows per page, the API does not allow a higher limit (tested via experimentation)
+PAGE_LIMIT = 100
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+# connection counters already reported by log_connection_stats, so that every run only logs its own numbers
+_reported_connection_stats = {"connections": 0, "requests": 0}
+
+
+@functools.cache
+def get_credentials() -> str:
+    """
+    Returns the "<public key>:<secret key>" of the Langfuse project, resolved on first use and cached,
+    so that importing this module does not look up any secret.
+    """
+    # imported here, only the blocks calling Langfuse need them
+    from mage_ai.data_preparation.shared.secrets import get_secret_value
+
+    secret_name = constants.get_config_mapper()["secret_name"]
+    try:
+        credentials = get_secret_value(secret_name)
+    except AttributeError:
+        # this happens when running this as a script (not in mage) on a local machine)
+        import dotenv
+
+        dotenv.load_dotenv()
+        credentials = os.getenv(secret_name)
+        assert credentials is not None, f"Credentials for {secret_name} not found"
+    return credentials
+
+
+@functools.cache
+def get_headers() -> dict[str, str]:
+    return {
+        "Authorization": f"Basic {b64encode(get_credentials().encode()).decode()}",
+        "Content-Type": "application/json",
+    }
+
+
+def get_pool_size() -> int:
+    """
+    Returns the most requests a block sends at the same time: the observation workers of the pipelined loader
+    next to its trace and score pagers, or the pagers of the shards of a backfill running at the same time.
+    """
+    pipelined_fetchers = constants.OBSERVATION_FETCH_MAX_WORKERS + 2 * constants.PAGE_FETCH_CONCURRENCY
+    backfill_fetchers = constants.BACKFILL_CONCURRENCY * constants.PAGE_FETCH_CONCURRENCY
+    return max(pipelined_fetchers, backfill_fetchers)
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the process-wide HTTP session, creating it on first use.
+    The session keeps connections to Langfuse alive and reuses them, so that not every request pays for a new
+    TCP/TLS handshake. The pool has a connection for every thread that can fetch at the same time (see
+    get_pool_size), threads would otherwise wait for a free connection (pool_block) instead of opening
+    throwaway connections that would not be kept.
+    """
+    global _session  # noqa: PLW0603
+    with _session_lock:
+        if _session is None:
+            pool_size = get_pool_size()
+            # retries are handled by tenacity in make_request, not by urllib3
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def get_connection_stats() -> dict[str, int]:
+    """
+    Returns the number of connections opened (ie, TCP/TLS handshakes) and requests sent by the session so far.
+    """
+    stats = {"connections": 0, "requests": 0}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():  # noqa: SIM118 (RecentlyUsedContainer does not support iteration)
+            pool = pools.get(key)
+            if pool is not None:
+                stats["connections"] += pool.num_connections
+                stats["requests"] += pool.num_requests
+    return stats
+
+
+def log_connection_stats():
+    """
+    Logs how many connections were opened and how many requests reused an open connection since the last call.
+    """
+    stats = get_connection_stats()
+    connections = stats["connections"] - _reported_connection_stats["connections"]
+    requests_sent = stats["requests"] - _reported_connection_stats["requests"]
+    _reported_connection_stats.update(stats)
+    logger.info(
+        f"HTTP connection stats: {requests_sent=}, handshakes={connections}, "
+        f"reused={max(requests_sent - connections, 0)}"
+    )
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the threads of the process that call the Langfuse API.
+    A 429 response pauses every caller for the 'Retry-After' period and halves the rate,
+    which then recovers step by step with every successful request, up to the configured maximum.
+    """
+
+    def __init__(self, max_rate: float, capacity: float, min_rate: float, recovery_step: float) -> None:
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.recovery_step = recovery_step
+        self.capacity = capacity
+        self.rate = max_rate
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        # number of 429 responses so far, see AdaptiveConcurrency
+        self.throttled_count = 0
+
+    def acquire(self):
+        """
+        Blocks until the caller is allowed to send a request.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+    def on_throttled(self, retry_after: float | None):
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + (retry_after if retry_after is not None else 1))
+            self.throttled_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            # no burst right after the pause, tokens only accumulate again once it is over
+            self._tokens = 0
+            self._updated_at = self._paused_until
+            logger.warning(
+                f"Rate limited by Langfuse, pausing all requests for {retry_after=}s, new rate={self.rate:.1f}/s"
+            )
+
+
+rate_limiter = RateLimiter(
+    max_rate=constants.LANGFUSE_REQUESTS_PER_SECOND,
+    capacity=constants.LANGFUSE_REQUESTS_PER_SECOND,
+    min_rate=1,
+    # back from min_rate to max_rate after ~50 successful requests
+    recovery_step=constants.LANGFUSE_REQUESTS_PER_SECOND / 50,
+)
+
+
+class AdaptiveConcurrency:
+    """
+    Adapts the number of tasks running at the same time with additive increase and multiplicative decrease (AIMD).
+    After every window of completed tasks (as many as the current limit), the limit grows by one,
+    or is halved when a request was throttled (429) during the window or the median task latency of the window rose
+    above constants.FETCH_LATENCY_TOLERANCE times the lowest median seen. The lowest median slowly drifts up,
+    so that a lasting slowdown of Langfuse becomes the new reference instead of pinning the limit to the floor.
+    More threads than the limit can run tasks, the extra ones wait in 'slot'.
+    """
+
+    def __init__(self, name: str, initial: int, floor: int, ceiling: int) -> None:
+        self.name = name
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = max(floor, min(ceiling, initial))
+        # (seconds since the start, limit) of every change
+        self.history = [(0.0, self.limit)]
+        self._active = 0
+        self._window_latencies = []
+        self._window_throttled_count = rate_limiter.throttled_count
+        self._baseline_latency = None
+        self._started_at = time.monotonic()
+        self._condition = threading.Condition()
+        utils_metrics.set_gauge("langfuse_fetch_concurrency", self.limit, stage=self.name)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Waits until fewer tasks than the limit run, then runs the task in the context and records its latency.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            latency = time.monotonic() - started_at
+            with self._condition:
+                self._active -= 1
+                self._window_latencies.append(latency)
+                if len(self._window_latencies) >= self.limit:
+                    self._adjust()
+                self._condition.notify_all()
+
+    def _adjust(self) -> None:
+        median_latency = statistics.median(self._window_latencies)
+        throttled = rate_limiter.throttled_count > self._window_throttled_count
+        if self._baseline_latency is None:
+            self._baseline_latency = median_latency
+        self._baseline_latency = min(median_latency, self._baseline_latency * 1.05)
+        if throttled or median_latency > self._baseline_latency * constants.FETCH_LATENCY_TOLERANCE:
+            limit = max(self.floor, self.limit // 2)
+        else:
+            limit = min(self.ceiling, self.limit + 1)
+        if limit != self.limit:
+            logger.info(
+                f"{self.name} concurrency {self.limit} -> {limit} ({median_latency=:.2f}s, "
+                f"baseline={self._baseline_latency:.2f}s, {throttled=})"
+            )
+            self.limit = limit
+            self.history.append((round(time.monotonic() - self._started_at, 1), limit))
+            utils_metrics.set_gauge("langfuse_fetch_concurrency", limit, stage=self.name)
+        self._window_latencies = []
+        self._window_throttled_count = rate_limiter.throttled_count
+
+    def log_summary(self) -> None:
+        """
+        Logs the range and the time-weighted average of the limit, every change was logged when it happened.
+        """
+        elapsed = time.monotonic() - self._started_at
+        changes = [*self.history, (elapsed, self.limit)]
+        weighted = sum((end - start) * limit for (start, limit), (end, _) in pairwise(changes))
+        limits = [limit for _, limit in self.history]
+        logger.info(
+            f"{self.name} concurrency: {len(self.history) - 1} changes in {elapsed:.0f}s, "
+            f"between {min(limits)} and {max(limits)}, {weighted / elapsed if elapsed else self.limit:.1f} on average, "
+            f"{self.limit} at the end"
+        )
 
 
 def get_retry_after(response):
@@ -68,16 +316,43 @@ def wait_time(retry_state):
     return wait_fixed(val)(retry_state)
 
 
+def get_endpoint(url: str) -> str:
+    """
+    Returns the endpoint of the API url (eg "traces", or "traces/{id}" for the detail of a trace),
+    the label of its run metrics.
+    """
+    path, _, resource_id = url.removeprefix(BASE_URL).strip("/").partition("/")
+    return f"{path}/{{id}}" if resource_id else path
+
+
 def log_before_sleep(retry_state):
     """
     Logs a warning message before sleeping in a retry attempt.
     """
+    utils_metrics.increment("langfuse_request_retries_total", endpoint=get_endpoint(retry_state.args[0]))
     logger.warning(
         f"Request failed. Attempt {retry_state.attempt_number}/{attempt_count}. "
         f"Waiting {retry_state.next_action.sleep if retry_state.next_action else 'unknown'} seconds before retry. "
     )
 
 
+def _get(url, headers, params) -> requests.Response:
+    """
+    Sends a single GET request, recording its latency, status and size in the run metrics.
+    """
+    endpoint = get_endpoint(url)
+    started_at = time.perf_counter()
+    try:
+        response = get_session().get(url, headers=headers, params=params, timeout=10)
+    except requests.exceptions.RequestException:
+        utils_metrics.increment("langfuse_requests_total", endpoint=endpoint, status="error")
+        raise
+    utils_metrics.observe("langfuse_request_duration_seconds", time.perf_counter() - started_at, endpoint=endpoint)
+    utils_metrics.increment("langfuse_requests_total", endpoint=endpoint, status=response.status_code)
+    utils_metrics.increment("langfuse_response_bytes_total", len(response.content), endpoint=endpoint)
+    return response
+
+
 @retry(
     stop=stop_after_attempt(attempt_count),
     wait=wait_time,
@@ -87,10 +362,15 @@ def log_before_sleep(retry_state):
 def make_request(url, headers, params):
     """
     Performs an HTTP GET request with retries. Raises an exception if all attempts fail.
+    Every attempt waits for the shared rate limiter first.
     """
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        rate_limiter.acquire()
+        response = _get(url, headers, params)
+        if response.status_code == 429:
+            rate_limiter.on_throttled(get_retry_after(response))
         response.raise_for_status()
+        rate_limiter.on_success()
         return response
     except Exception as e:
         logger.warning(f"Request failed: {url=}, {params=}, {e=}")
@@ -117,16 +397,71 @@ def calculate_start_and_end_dates(days_back: int, **kwargs) -> tuple[str, str]:
     return start_from_date_str, end_date_str
 
 
-def fetch_all_pages(
+def apply_watermark(start_from_date: str, end_date: str, watermark: datetime | None) -> str:
+    """
+    Returns the start of the window for an incremental sync: the watermark (the latest timestamp already exported)
+    minus constants.WATERMARK_OVERLAP, when that is inside the window calculated by calculate_start_and_end_dates.
+    Otherwise (no watermark yet, or a backfill of a window that ends before the watermark) the start is unchanged.
+    """
+    if watermark is None:
+        return start_from_date
+    incremental_start = (watermark - constants.WATERMARK_OVERLAP).astimezone(timezone.utc)
+    window_start = datetime.strptime(start_from_date, "%Y-%m-%dT%H:%M:%S%z")
+    window_end = datetime.strptime(end_date, "%Y-%m-%dT%H:%M:%S%z")
+    if not window_start < incremental_start < window_end:
+        logger.info(f"Watermark {watermark} is outside of the window, fetching the full window")
+        return start_from_date
+    logger.info(f"Incremental sync from {incremental_start} (watermark {watermark})")
+    return incremental_start.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _fetch_page(
+    url: str, headers: dict[str, str], params: dict[str, Any], page: int, spill_dir: Path | None = None
+) -> dict[str, Any]:
+    """
+    Fetches a single page and returns the decoded response body (with 'data' and 'meta').
+    With a 'spill_dir', a page spilled by a previous attempt is read from there instead,
+    and a fetched page is spilled there.
+    """
+    if spill_dir is not None and (content := utils_spill.read_page(spill_dir, page)) is not None:
+        utils_metrics.increment("langfuse_pages_total", endpoint=get_endpoint(url), source="spill")
+        return json.loads(content)
+
+    page_params = {**params, "page": page}
+    if page % 10 == 0:
+        logger.debug(f"Fetching page {page}")
+    response = make_request(url, headers, page_params)
+
+    if response.status_code != 200:
+        logger.error(f"Error fetching page {page}: {response.status_code} {response.text}")
+        response.raise_for_status()
+
+    utils_metrics.increment("langfuse_pages_total", endpoint=get_endpoint(url), source="api")
+    if spill_dir is not None:
+        utils_spill.write_page(spill_dir, page, response.content)
+    return response.json()
+
+
+def iter_pages(
     path: Literal["traces", "observations", "scores"],
-    start_from_date: str,
-    end_date: str,
+    start_from_date: str | None,
+    end_date: str | None,
     params: dict[str, Any] | None = None,
-):
+    concurrency: int | None = None,
+    spill: bool = False,
+) -> Iterator[list[dict[str, Any]]]:
     """
-    Fetches the data for multiple pages, up to the limit imposed by the given path,
+    Yields the data of every page, in page order, for the given path,
     starting from 'start_from_date' until 'end_date' (UTC).
-    Returns a list combining all pages of data.
+    A date set to None is not sent as a filter (requests drops parameters with a None value).
+
+    With 'concurrency' set, the total number of pages is read from the 'meta.totalPages' of the first
+    response and the following pages are fetched in parallel by up to 'concurrency' threads.
+    Only a few pages are fetched ahead of the consumer, so memory does not grow with the number of pages.
+
+    With 'spill', every fetched page is also written to a local spill directory (see utils_spill), so that
+    a retried block run only fetches the pages that the failed attempt did not get to.
+    The spill has to be cleared with utils_spill.clear_spill once the data was exported.
     """
     if params is None:
         params = {}
@@ -143,26 +478,145 @@ def fetch_all_pages(
             # Retrieve only observations with a start_time or or after this datetime (ISO 8601).
             params["fromStartTime"] = start_from_date
             params["toStartTime"] = end_date
-    params["limit"] = 100  # API does not allow a higher limit (tested via experimentation)
+    params["limit"] = PAGE_LIMIT
+
+    url = f"{BASE_URL}/{path}"
+    headers = get_headers()
+    spill_dir = utils_spill.get_spill_dir(path, end_date, params) if spill else None
+    if concurrency is not None:
+        yield from _iter_pages_concurrently(url, headers, params, concurrency, spill_dir)
+    else:
+        yield from _iter_pages_sequentially(url, headers, params, spill_dir=spill_dir)
+
 
-    headers = {"Authorization": f"Basic {b64encode(credentials.encode()).decode()}", "Content-Type": "application/json"}
-    page = 1
+def iter_batches(
+    path: Literal["traces", "observations", "scores"],
+    start_from_date: str | None,
+    end_date: str | None,
+    batch_size: int,
+    params: dict[str, Any] | None = None,
+    concurrency: int | None = None,
+    spill: bool = False,
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Same as iter_pages, but yields batches of 'batch_size' rows (the last batch can be smaller).
+    """
+    return batch_pages(iter_pages(path, start_from_date, end_date, params, concurrency, spill), batch_size)
+
+
+def batch_pages(pages: Iterable[list[dict[str, Any]]], batch_size: int) -> Iterator[list[dict[str, Any]]]:
+    """
+    Regroups the data of the given pages into batches of 'batch_size' rows (the last batch can be smaller).
+    """
+    batch = []
+    for page_data in pages:
+        batch.extend(page_data)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+def fetch_all_pages(
+    path: Literal["traces", "observations", "scores"],
+    start_from_date: str | None,
+    end_date: str | None,
+    params: dict[str, Any] | None = None,
+    concurrency: int | None = None,
+):
+    """
+    Fetches the data for multiple pages, see iter_pages.
+    Returns a list combining all pages of data.
+    """
     all_data = []
-    while True:
-        params["page"] = page
-        if page % 10 == 0:
-            logger.debug(f"Fetching page {page}")
-        response = make_request(f"{BASE_URL}/{path}", headers, params)
-
-        if response.status_code != 200:
-            logger.error(f"Error fetching page {page}: {response.status_code} {response.text}")
-            response.raise_for_status()
-
-        data = response.json()
-        extracted_data = data["data"]
-        if not extracted_data:
-            break
-        all_data.extend(extracted_data)
+    for page_data in iter_pages(path, start_from_date, end_date, params, concurrency):
+        all_data.extend(page_data)
+    return all_data
+
+
+def fetch_trace_detail(trace_id: str) -> dict[str, Any]:
+    """
+    Fetches a single trace with its observations and scores embedded, in one request (GET /traces/{id}).
+    """
+    url = f"{BASE_URL}/traces/{quote(trace_id, safe='')}"
+    return make_request(url, get_headers(), None).json()
+
+
+def fetch_trace_observations(trace_id: str, start_from_date: str | None, end_date: str | None) -> list[dict[str, Any]]:
+    """
+    Fetches the observations of a single trace, with constants.PER_TRACE_FETCH_METHOD:
+    - "pages": pages through /observations?traceId=..., with the time filter. concurrency=1 reads meta.totalPages,
+      so up to PAGE_LIMIT observations take a single request (no request for the empty terminating page).
+    - "trace_detail": takes the observations embedded in /traces/{id}, a single request whatever their number,
+      without the time filter. Falls back to the pages when the observations are not embedded in full (eg only
+      their ids, like in the trace list).
+    """
+    if constants.PER_TRACE_FETCH_METHOD == "trace_detail":
+        observations = fetch_trace_detail(trace_id).get("observations")
+        if isinstance(observations, list) and all(isinstance(observation, dict) for observation in observations):
+            return observations
+        logger.warning(f"The observations of {trace_id=} are not embedded in its detail, fetching their pages")
+        utils_metrics.increment("langfuse_trace_detail_fallbacks_total")
+    return fetch_all_pages("observations", start_from_date, end_date, {"traceId": trace_id}, concurrency=1)
+
+
+def _iter_pages_sequentially(
+    url: str, headers: dict[str, str], params: dict[str, Any], start_page: int = 1, spill_dir: Path | None = None
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Fetches pages one by one, starting from 'start_page', until an empty page is returned.
+    """
+    page = start_page
+    while extracted_data := _fetch_page(url, headers, params, page, spill_dir)["data"]:
+        yield extracted_data
         page += 1
 
-    return all_data
+
+def _iter_pages_concurrently(
+    url: str, headers: dict[str, str], params: dict[str, Any], concurrency: int, spill_dir: Path | None = None
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Fetches the first page to learn 'meta.totalPages', then fetches the remaining pages in parallel.
+    Rows created meanwhile push the last rows past 'meta.totalPages', so when the last page is full,
+    the pages after it are fetched sequentially until an empty page is returned.
+    """
+    first_page = _fetch_page(url, headers, params, 1, spill_dir)
+    if first_page["data"]:
+        yield first_page["data"]
+    last_page_data = first_page["data"]
+    total_pages = (first_page.get("meta") or {}).get("totalPages")
+    if total_pages is None:
+        # should not happen with the public API, but we do not want to silently drop pages
+        logger.warning(f"No meta.totalPages in the response for {url=}, falling back to sequential fetching")
+        yield from _iter_pages_sequentially(url, headers, params, start_page=2, spill_dir=spill_dir)
+        return
+
+    if total_pages > 1:
+        logger.info(f"Fetching {total_pages} pages from {url=} with {concurrency=}")
+        pages = iter(range(2, total_pages + 1))
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            # pages are yielded in page order, regardless of which request finishes first,
+            # while at most 2 * concurrency pages are fetched ahead of the consumer
+            pending = deque(
+                executor.submit(_fetch_page, url, headers, params, page, spill_dir)
+                for page in islice(pages, 2 * concurrency)
+            )
+            while pending:
+                last_page_data = pending.popleft().result()["data"]
+                if (page := next(pages, None)) is not None:
+                    pending.append(executor.submit(_fetch_page, url, headers, params, page, spill_dir))
+                yield last_page_data
+        except BaseException:
+            # the consumer stopped early (GeneratorExit) or a page failed: the pages in flight are not needed,
+            # so their fetches (and retries, with minutes of backoff) are neither waited for nor started
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    if len(last_page_data) >= params["limit"]:
+        logger.info(f"The last of the {total_pages} pages of {url=} is full, fetching the pages after it")
+        yield from _iter_pages_sequentially(
+            url, headers, params, start_page=max(total_pages, 1) + 1, spill_dir=spill_dir
+        )
@@ -1,33 +1,351 @@
+import atexit
+import functools
+import hashlib
+import io
 import os
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Any
 
 import pandas as pd
-from mage_ai.io.config import ConfigFileLoader
-from mage_ai.io.postgres import Postgres
-from mage_ai.settings.repo import get_repo_path
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 
-from lodgify.utils.ai_tools import constants
+from lodgify.utils.ai_tools import constants, schemas, utils_indexes, utils_metrics, utils_partitions, utils_spill
 from lodgify.utils.ai_tools.logger import logger
 
+if TYPE_CHECKING:
+    from mage_ai.io.config import ConfigFileLoader
+    from psycopg2.pool import ThreadedConnectionPool
 
-def export_data(data: pd.DataFrame, schema_name: str, table_name: str):
+_pool: "ThreadedConnectionPool | None" = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool fails when all its connections are in use, callers wait for a free one instead
+_pool_slots = threading.BoundedSemaphore(constants.POSTGRES_POOL_SIZE)
+# connection held by every thread (and the callbacks to run once its transaction is committed), see connection
+_held = threading.local()
+
+# table and column of the watermark of every entity, see save_entity
+ENTITY_TABLES = {
+    "traces": ("LangfuseTraces", "Timestamp"),
+    "observations": ("LangfuseObservations", "StartTime"),
+    "scores": ("LangfuseScores", "Timestamp"),
+}
+# column of the daily partitions of every table with constants.PARTITION_TABLES
+_PARTITION_COLUMNS = dict(ENTITY_TABLES.values())
+
+
+@functools.cache
+def get_config_loader() -> "ConfigFileLoader":
+    """
+    Returns the loader of the io_config.yaml profile of the target database, read once per process.
+    Like mage_ai.io.postgres, mage_ai.io is only imported when a block first talks to postgres.
+    """
+    from mage_ai.io.config import ConfigFileLoader
+    from mage_ai.settings.repo import get_repo_path
+
+    config_profile = constants.get_config_mapper()["io_config_profile_name"]
+    logger.debug(f"Extracted config_profile: {config_profile}")
+    config_path = os.path.join(get_repo_path(), "io_config.yaml")
+    return ConfigFileLoader(config_path, config_profile)
+
+
+def get_pool() -> "ThreadedConnectionPool":
+    """
+    Returns the process-wide pool of connections to the target database, creating it on first use.
+    The blocks run by the same process share its connections (and the parsed io_config.yaml) instead of opening
+    a new connection for every export, watermark or checkpoint.
+    """
+    global _pool  # noqa: PLW0603
+    with _pool_lock:
+        if _pool is None:
+            from mage_ai.io.config import ConfigKey
+            from psycopg2.pool import ThreadedConnectionPool
+
+            config = get_config_loader()
+            connect_timeout = config.get(ConfigKey.POSTGRES_CONNECT_TIMEOUT)
+            _pool = ThreadedConnectionPool(
+                0,
+                constants.POSTGRES_POOL_SIZE,
+                dbname=config.get(ConfigKey.POSTGRES_DBNAME),
+                user=config.get(ConfigKey.POSTGRES_USER),
+                password=config.get(ConfigKey.POSTGRES_PASSWORD),
+                host=config.get(ConfigKey.POSTGRES_HOST),
+                port=config.get(ConfigKey.POSTGRES_PORT),
+                # like mage_ai.io.postgres, so that idle pooled connections are not dropped by the network
+                keepalives=1,
+                keepalives_idle=300,
+                **({"connect_timeout": connect_timeout} if connect_timeout else {}),
+            )
+            # the pool only keeps up to minconn returned connections, which it would all open right away,
+            # so the connections are opened on demand, and kept once opened
+            _pool.minconn = constants.POSTGRES_POOL_SIZE
+            atexit.register(_pool.closeall)
+    return _pool
+
+
+def _is_alive(conn) -> bool:
+    # a pooled connection can have been closed by the server (eg idle timeout or restart) since it was returned
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+    return True
+
+
+@contextmanager
+def connection(own: bool = False) -> Iterator[Any]:
+    """
+    Yields a psycopg2 connection to the target database, borrowed from the pool of the process (see get_pool),
+    waiting while all of them are in use. The transaction is committed when the block succeeds and rolled back
+    otherwise, then the connection goes back to the pool.
+    A block nested in another one of the same thread (eg the payloads written while a batch is exported) gets
+    the connection of the outer block and runs in its transaction: waiting for a second connection would never end
+    when every pooled connection is held by such an outer block.
+    With 'own', a nested block borrows a connection of its own anyway, for the statements that must not run
+    in the transaction of the outer block (eg the marker reads of the pipelined loader, see get_observation_sync).
+    """
+    held_conn = getattr(_held, "conn", None)
+    if held_conn is not None and not own:
+        yield held_conn
+        return
+    outer_held = held_conn, getattr(_held, "on_commit", None)
+    pool = get_pool()
+    with _pool_slots:
+        conn = pool.getconn()
+        while not _is_alive(conn):
+            logger.warning("Discarding a closed pooled connection to postgres")
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        _held.conn = conn
+        _held.on_commit = []
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            committed_callbacks = _held.on_commit
+            _held.conn, _held.on_commit = outer_held
+            pool.putconn(conn, close=bool(conn.closed))
+    for callback in committed_callbacks:
+        callback()
+
+
+def on_commit(callback: Callable[[], None]) -> None:
+    """
+    Runs the callback once the transaction of the connection held by the thread is committed (see connection),
+    not at all when it is rolled back.
+    """
+    _held.on_commit.append(callback)
+
+
+@contextmanager
+def autocommit_connection() -> Iterator[Any]:
+    """
+    Yields a pooled connection (see connection) in autocommit mode, for the statements that cannot run
+    in a transaction, eg CREATE INDEX CONCURRENTLY.
+    """
+    with connection() as conn:
+        # ends the transaction of the liveness check
+        conn.rollback()
+        conn.autocommit = True
+        try:
+            yield conn
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
+
+
+def ensure_indexes(table_name: str, schema_name: str = "public") -> None:
+    """
+    Builds the constants.SECONDARY_INDEXES of the table that are missing, see utils_indexes.build_missing_indexes.
+    Skipped while a backfill defers them (see deferred_indexes) or another export builds them.
+    Never fails the export, the indexes are built again by the next one.
+    """
+    try:
+        with autocommit_connection() as conn:
+            if not _table_exists(conn, schema_name, table_name):
+                return
+            with conn.cursor() as cursor:
+                if not utils_indexes.lock_indexes(cursor, schema_name, table_name, wait=False):
+                    logger.info(f"Not building the indexes of {table_name}, they are deferred or being built")
+                    return
+                try:
+                    utils_indexes.build_missing_indexes(cursor, schema_name, table_name)
+                finally:
+                    utils_indexes.unlock_indexes(cursor, schema_name, table_name)
+    except Exception:
+        logger.exception(f"Could not build the indexes of {table_name}")
+
+
+@contextmanager
+def deferred_indexes(table_name: str, schema_name: str = "public") -> Iterator[None]:
+    """
+    Drops the constants.SECONDARY_INDEXES of the table for the bulk load in the context,
+    and builds them again after it, also when it fails.
+    The advisory lock of the indexes is held meanwhile, on a connection borrowed for the whole context, so that
+    the exports running alongside (eg the scheduled ones) do not build them again. Postgres releases it
+    if the process dies.
+    """
+    try:
+        with autocommit_connection() as conn, conn.cursor() as cursor:
+            utils_indexes.lock_indexes(cursor, schema_name, table_name)
+            try:
+                if _table_exists(conn, schema_name, table_name):
+                    utils_indexes.drop_secondary_indexes(cursor, schema_name, table_name)
+                yield
+            finally:
+                if not conn.closed:
+                    utils_indexes.unlock_indexes(cursor, schema_name, table_name)
+    finally:
+        ensure_indexes(table_name, schema_name)
+
+
+def export_data(data: pd.DataFrame, schema_name: str, table_name: str, replace_days: Iterable[date] = ()) -> bool:
+    """
+    Upserts the data into the table, see export_batches. Returns whether the data was exported successfully.
+    """
     if not isinstance(data, pd.DataFrame):
         logger.warning("Data is not a pandas DataFrame, skipping saving to postgres")
-        return
+        return False
     if data.empty:
         logger.warning("Data is empty, skipping saving to postgres")
-        return
+        return False
 
     try:
-        config_profile = constants.get_config_mapper()["io_config_profile_name"]
-        # Additional debugging prints to verify DataFrame and config_profile
+        # Additional debugging prints to verify DataFrame
         logger.debug(f"Size of data: {data.shape=}")
         logger.debug(f"Extracted DataFrame: {data}")
-        logger.debug(f"Extracted config_profile: {config_profile}")
-        config_path = os.path.join(get_repo_path(), "io_config.yaml")
+        batches = (data.iloc[i : i + constants.BATCH_SIZE] for i in range(0, len(data), constants.BATCH_SIZE))
+        export_batches(batches, schema_name, table_name, replace_days)
+    except Exception:
+        logger.exception("An error occurred")
+        utils_metrics.increment("langfuse_export_failures_total", table=table_name)
+        return False
+    return True
+
+
+def get_window(**kwargs) -> tuple[str, str]:
+    """
+    Returns the DAYS_BACK window of the run, as calculated by the loaders (before applying a watermark).
+    """
+    # imported here, the exporters only need the Langfuse client for this
+    from lodgify.utils.ai_tools import utils_langfuse
+
+    return utils_langfuse.calculate_start_and_end_dates(constants.DAYS_BACK, **kwargs)
+
+
+def get_window_days(**kwargs) -> list[date]:
+    """
+    Returns the days of the DAYS_BACK window of the run, which the loaders fetch in full with constants.REPLACE_WINDOW.
+    """
+    start_from_date, end_date = get_window(**kwargs)
+    first_day = date.fromisoformat(start_from_date[:10])
+    return [
+        first_day + timedelta(days=offset) for offset in range((date.fromisoformat(end_date[:10]) - first_day).days)
+    ]
+
+
+def save_entity(entity: str, data: pd.DataFrame, schema_name: str = "public", **kwargs) -> bool:
+    """
+    Exports the output of the loader of the entity to its table (see ENTITY_TABLES), then moves the watermark
+    of the entity, removes its spilled pages and builds the missing indexes of the table.
+    Returns whether the data was exported successfully.
+    With constants.REPLACE_WINDOW, the partitions of the days of the window (of the run in kwargs) are replaced,
+    except for the observations fetched per trace, which are not all the observations of the window.
+    """
+    table_name, watermark_column = ENTITY_TABLES[entity]
+    replace_days = []
+    if constants.REPLACE_WINDOW and (entity != "observations" or constants.OBSERVATION_FETCH_MODE == "window"):
+        replace_days = get_window_days(**kwargs)
+    exported = export_data(data, schema_name=schema_name, table_name=table_name, replace_days=replace_days)
+    if exported:
+        update_watermark(entity, data[watermark_column], schema_name=schema_name)
+        utils_spill.clear_spill(entity, get_window(**kwargs)[1])
+        ensure_indexes(table_name, schema_name=schema_name)
+    # an empty output is a success too, eg when none of the traces fetched by the run has observations
+    run_id = get_run_id(**kwargs)
+    if entity == "observations" and run_id and (exported or (isinstance(data, pd.DataFrame) and data.empty)):
+        commit_observation_sync(run_id, schema_name=schema_name)
+    return exported
+
+
+def save_entities(data_by_entity: dict[str, pd.DataFrame], schema_name: str = "public", **kwargs) -> dict[str, bool]:
+    """
+    Saves the output of the loader of every entity, see save_entity. With constants.PARALLEL_EXPORT the tables are
+    written at the same time over separate pooled connections, so that it takes about as long as the largest table.
+    Returns whether every entity was exported successfully.
+    """
+    started_at = time.perf_counter()
+    if constants.PARALLEL_EXPORT:
+        with ThreadPoolExecutor(max_workers=len(data_by_entity), thread_name_prefix="export") as executor:
+            futures = {
+                entity: executor.submit(save_entity, entity, data, schema_name, **kwargs)
+                for entity, data in data_by_entity.items()
+            }
+        exported = {entity: future.result() for entity, future in futures.items()}
+    else:
+        exported = {entity: save_entity(entity, data, schema_name, **kwargs) for entity, data in data_by_entity.items()}
+    logger.info(f"Saved {exported=} in {time.perf_counter() - started_at:.1f}s ({constants.PARALLEL_EXPORT=})")
+    return exported
+
+
+def export_batches(
+    batches: Iterable[pd.DataFrame], schema_name: str, table_name: str, replace_days: Iterable[date] = ()
+) -> int:
+    """
+    Writes every batch to postgres as soon as it arrives, so that only one batch has to be held in memory
+    (and serialized for the export) at a time. Returns the number of exported rows.
+    The timestamps are written as the ISO 8601 text of the API, see schemas.format_timestamps.
+    With constants.PARTITION_TABLES, the entity tables are partitioned by day (converted by their first export),
+    and the partitions of the 'replace_days' are replaced with the rows of these days instead of upserting them.
+    """
+    batches = (_with_content_hash(schemas.format_timestamps(batch)) for batch in batches)
+    if constants.EXPORT_METHOD == "copy":
+        with connection() as conn:
+            if _table_exists(conn, schema_name, table_name):
+                if constants.PARTITION_TABLES:
+                    _ensure_partitioned(conn, schema_name, table_name)
+                return _copy_upsert(conn, batches, schema_name, table_name, replace_days)
+        logger.warning(f"Table {table_name} does not exist yet, creating it with the mage export")
+    return _mage_export(batches, schema_name, table_name)
+
+
+def _record_export_metrics(table_name: str, seconds_by_phase: dict[str, float], rows_by_result: dict[str, int]) -> None:
+    for phase, seconds in seconds_by_phase.items():
+        utils_metrics.increment("langfuse_export_seconds_total", seconds, table=table_name, phase=phase)
+    for result, rows in rows_by_result.items():
+        utils_metrics.increment("langfuse_export_rows_total", rows, table=table_name, result=result)
+    elapsed = sum(seconds_by_phase.values())
+    if elapsed:
+        utils_metrics.set_gauge(
+            "langfuse_export_rows_per_second", sum(rows_by_result.values()) / elapsed, table=table_name
+        )
 
-        with Postgres.with_config(ConfigFileLoader(config_path, config_profile)) as loader:
+
+def _mage_export(batches: Iterable[pd.DataFrame], schema_name: str, table_name: str) -> int:
+    from mage_ai.io.postgres import Postgres
+
+    started_at = time.perf_counter()
+    exported_rows = 0
+    with Postgres.with_config(get_config_loader()) as loader:
+        for batch in batches:
+            if batch.empty:
+                continue
             loader.export(
-                data,
+                batch,
                 schema_name,
                 f'"{table_name}"',
                 index=False,  # Specifies whether to include index in exported table
@@ -37,5 +355,473 @@ def export_data(data: pd.DataFrame, schema_name: str, table_name: str):
                 if_exists="append",  # Specify resolution policy if table name already exists
                 case_sensitive=True,
             )
+            exported_rows += len(batch)
+            logger.debug(f"Exported {exported_rows} rows to {table_name}")
+    _record_export_metrics(table_name, {"mage": time.perf_counter() - started_at}, {"upserted": exported_rows})
+    return exported_rows
+
+
+def compute_content_hash(data: pd.DataFrame) -> pd.Series:
+    """
+    Returns a stable hash of the content of every row, ignoring the hash column itself.
+    Missing values (None/NaN) hash the same, and columns are taken in name order.
+    """
+    columns = sorted(column for column in data.columns if column != constants.CONTENT_HASH_COLUMN)
+    values = data[columns].astype(object)
+    values = values.where(values.notna(), "")
+    return pd.Series(
+        [
+            hashlib.blake2b("\x1f".join(map(str, row)).encode(), digest_size=16).hexdigest()
+            for row in values.itertuples(index=False, name=None)
+        ],
+        index=data.index,
+        dtype=object,
+    )
+
+
+def _with_content_hash(batch: pd.DataFrame) -> pd.DataFrame:
+    if batch.empty:
+        return batch
+    return batch.assign(**{constants.CONTENT_HASH_COLUMN: compute_content_hash(batch)})
+
+
+def _postgres_type(dtype) -> str:
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "bigint"
+    if pd.api.types.is_float_dtype(dtype):
+        return "double precision"
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return "timestamptz"
+    return "text"
+
+
+def _add_missing_columns(
+    conn, batch: pd.DataFrame, schema_name: str, table_name: str, column_types: dict[str, str]
+) -> None:
+    """
+    Adds the columns of the batch that the table does not have yet (eg the content hash), updating 'column_types'.
+    """
+    with conn.cursor() as cursor:
+        for column in batch.columns:
+            if column in column_types:
+                continue
+            column_types[column] = _postgres_type(batch[column].dtype)
+            logger.info(f"Adding column {column} ({column_types[column]}) to {table_name}")
+            cursor.execute(
+                sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}").format(
+                    sql.Identifier(schema_name, table_name), sql.Identifier(column), sql.SQL(column_types[column])
+                )
+            )
+
+
+def _table_exists(conn, schema_name: str, table_name: str) -> bool:
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", (sql.Identifier(schema_name, table_name).as_string(conn),))
+        return cursor.fetchone()[0] is not None
+
+
+def _get_column_types(conn, schema_name: str, table_name: str) -> dict[str, str]:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped",
+            (sql.Identifier(schema_name, table_name).as_string(conn),),
+        )
+        return dict(cursor.fetchall())
+
+
+def _cast_from_text(column: str, column_type: str) -> sql.Composable:
+    # integer columns can arrive as floats (eg 3.0) when a batch has missing values, numeric accepts both
+    if column_type in ("smallint", "integer", "bigint"):
+        return sql.SQL("{}::numeric::{}").format(sql.Identifier(column), sql.SQL(column_type))
+    return sql.SQL("{}::{}").format(sql.Identifier(column), sql.SQL(column_type))
+
+
+def _ensure_partitioned(conn, schema_name: str, table_name: str) -> None:
+    """
+    Converts the table into a table partitioned by day, see utils_partitions.partition_table. Its time column is
+    converted to a timestamptz first: the tables created by the mage export from the API strings have text ones.
+    Fails when the column is missing or holds a value that is not a timestamp.
+    """
+    column = _PARTITION_COLUMNS.get(table_name)
+    if column is None:
+        return
+    with conn.cursor() as cursor:
+        if utils_partitions.is_partitioned(cursor, schema_name, table_name):
+            return
+        column_type = _get_column_types(conn, schema_name, table_name).get(column)
+        if column_type is None:
+            raise ValueError(f"Cannot partition {table_name} by day on {column}, it has no such column")
+        if column_type != "timestamp with time zone":
+            logger.warning(f"Converting the column {column} of {table_name} from {column_type} to timestamptz")
+            cursor.execute(
+                sql.SQL("ALTER TABLE {} ALTER COLUMN {column} TYPE timestamptz USING {column}::timestamptz").format(
+                    sql.Identifier(schema_name, table_name), column=sql.Identifier(column)
+                )
+            )
+        utils_partitions.partition_table(cursor, schema_name, table_name, column)
+
+
+def _copy_upsert(
+    conn, batches: Iterable[pd.DataFrame], schema_name: str, table_name: str, replace_days: Iterable[date] = ()
+) -> int:
+    """
+    Streams the batches with COPY FROM STDIN into an unlogged staging table (with text columns),
+    then upserts all of them into the table with a single INSERT ... ON CONFLICT ("Id") DO UPDATE,
+    all within the transaction of the connection. The values are cast to the column types of the table there.
+    When an Id appears more than once, the last row wins.
+    Existing rows are only updated when their content hash changed.
+    Into a partitioned table, the missing partitions are created first, the conflicts are on ("Id", partition column),
+    and the rows of the 'replace_days' are loaded into fresh partitions replacing the ones of these days.
+    """
+    started_at = time.perf_counter()
+    target = sql.Identifier(schema_name, table_name)
+    staging = sql.Identifier(schema_name, f"{table_name}_staging_{uuid.uuid4().hex[:8]}")
+    column_types = _get_column_types(conn, schema_name, table_name)
+    columns = None
+    copied_rows = 0
+    with conn.cursor() as cursor:
+        for batch in batches:
+            if batch.empty:
+                continue
+            if columns is None:
+                columns = list(batch.columns)
+                _add_missing_columns(conn, batch, schema_name, table_name, column_types)
+                cursor.execute(
+                    sql.SQL('CREATE UNLOGGED TABLE {} ("_Row" bigserial, {})').format(
+                        staging, sql.SQL(", ").join(sql.SQL("{} text").format(sql.Identifier(c)) for c in columns)
+                    )
+                )
+            buffer = io.StringIO()
+            batch[columns].to_csv(buffer, header=False, index=False, na_rep=r"\N")
+            buffer.seek(0)
+            cursor.copy_expert(
+                sql.SQL(r"COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\N')")
+                .format(staging, sql.SQL(", ").join(map(sql.Identifier, columns)))
+                .as_string(conn),
+                buffer,
+            )
+            copied_rows += len(batch)
+            logger.debug(f"Copied {copied_rows} rows to the staging table of {table_name}")
+        if columns is None:
+            return 0
+        copied_at = time.perf_counter()
+
+        def select_source(where: sql.Composable) -> sql.Composable:
+            return sql.SQL(
+                'SELECT DISTINCT ON ("Id") {casts} FROM {staging} {where} ORDER BY "Id", "_Row" DESC'
+            ).format(
+                casts=sql.SQL(", ").join(_cast_from_text(column, column_types[column]) for column in columns),
+                staging=staging,
+                where=where,
+            )
+
+        conflict_columns = ["Id"]
+        upsert_filter = sql.SQL("")
+        replaced_rows = 0
+        partition_column = _PARTITION_COLUMNS.get(table_name)
+        partitioned = partition_column is not None and utils_partitions.is_partitioned(cursor, schema_name, table_name)
+        if partitioned:
+            conflict_columns.append(partition_column)
+            day = utils_partitions.day_of(partition_column)
+            cursor.execute(sql.SQL("SELECT DISTINCT {} FROM {}").format(day, staging))
+            days = {row_day for (row_day,) in cursor.fetchall()}
+            # only the days with rows, a day without any (eg a failed fetch) keeps its partition
+            replaced_days = sorted(days.intersection(replace_days))
+            for replaced_day in replaced_days:
+                replaced_rows += utils_partitions.replace_partition(
+                    cursor,
+                    schema_name,
+                    table_name,
+                    partition_column,
+                    replaced_day,
+                    columns,
+                    select_source(sql.SQL("WHERE {} = {}").format(day, sql.Literal(replaced_day))),
+                )
+            utils_partitions.create_partitions(cursor, schema_name, table_name, days.difference(replaced_days))
+            if replaced_days:
+                upsert_filter = sql.SQL("WHERE {} <> ALL({})").format(day, sql.Literal(replaced_days))
+        elif replace_days:
+            logger.warning(f"{table_name} is not partitioned, upserting the rows instead of replacing the window")
+
+        update_columns = [column for column in columns if column not in conflict_columns]
+        on_conflict = (
+            # rows with the same content hash are left untouched (no new row version, no WAL)
+            sql.SQL("DO UPDATE SET {updates} WHERE target.{hash} IS DISTINCT FROM EXCLUDED.{hash}").format(
+                updates=sql.SQL(", ").join(
+                    sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+                    for column in update_columns
+                ),
+                hash=sql.Identifier(constants.CONTENT_HASH_COLUMN),
+            )
+            if update_columns
+            else sql.SQL("DO NOTHING")
+        )
+        conflict = sql.SQL(", ").join(map(sql.Identifier, conflict_columns))
+        if partitioned:
+            # postgres cannot return xmax from a partitioned table once a row is updated. The statement sees the table
+            # as it was before the insert, so the updated rows are the ones that were already in it
+            returning = sql.SQL("RETURNING {}").format(conflict)
+            counts = sql.SQL(
+                'count(*) FILTER (WHERE existing."Id" IS NULL), count(*) FILTER (WHERE existing."Id" IS NOT NULL) '
+                "FROM upserted LEFT JOIN {} AS existing USING ({})"
+            ).format(target, conflict)
+        else:
+            returning = sql.SQL("RETURNING (xmax = 0) AS inserted")
+            counts = sql.SQL("count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted")
+        cursor.execute(
+            sql.SQL(
+                "WITH source AS ({source}), "
+                "upserted AS (INSERT INTO {target} AS target ({columns}) SELECT * FROM source "
+                "ON CONFLICT ({conflict}) {on_conflict} {returning}) "
+                "SELECT (SELECT count(*) FROM source), {counts}"
+            ).format(
+                source=select_source(upsert_filter),
+                target=target,
+                columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+                conflict=conflict,
+                on_conflict=on_conflict,
+                returning=returning,
+                counts=counts,
+            )
+        )
+        source_rows, inserted_rows, updated_rows = cursor.fetchone()
+        unchanged_rows = source_rows - inserted_rows - updated_rows
+        cursor.execute(sql.SQL("DROP TABLE {}").format(staging))
+
+    elapsed = time.perf_counter() - started_at
+    loaded_rows = source_rows + replaced_rows
+    logger.info(
+        f"Loaded {loaded_rows} rows into {table_name} in {elapsed:.1f}s "
+        f"({copied_rows / elapsed:.0f} rows/s, COPY took {copied_at - started_at:.1f}s): "
+        f"inserted={inserted_rows} ({inserted_rows / loaded_rows:.1%}), "
+        f"updated={updated_rows} ({updated_rows / loaded_rows:.1%}), "
+        f"unchanged={unchanged_rows} ({unchanged_rows / loaded_rows:.1%}), "
+        f"replaced={replaced_rows} ({replaced_rows / loaded_rows:.1%})"
+    )
+    _record_export_metrics(
+        table_name,
+        # the COPY phase includes the time spent waiting for the batches, which are fetched while they are copied
+        {"copy": copied_at - started_at, "upsert": elapsed - (copied_at - started_at)},
+        {"inserted": inserted_rows, "updated": updated_rows, "unchanged": unchanged_rows, "replaced": replaced_rows},
+    )
+    return copied_rows
+
+
+def _ensure_sync_state_table(cursor, state_table: sql.Identifier) -> None:
+    cursor.execute(
+        sql.SQL(
+            'CREATE TABLE IF NOT EXISTS {} ("Entity" text PRIMARY KEY, "Watermark" timestamptz NOT NULL, '
+            '"UpdatedAt" timestamptz NOT NULL DEFAULT now())'
+        ).format(state_table)
+    )
+
+
+def get_watermark(entity: str, schema_name: str = "public") -> datetime | None:
+    """
+    Returns the latest timestamp of the entity that was successfully exported,
+    or None if there is none yet (or the state table cannot be read, then the full window is fetched).
+    """
+    state_table = sql.Identifier(schema_name, constants.SYNC_STATE_TABLE)
+    try:
+        with connection() as conn, conn.cursor() as cursor:
+            _ensure_sync_state_table(cursor, state_table)
+            cursor.execute(sql.SQL('SELECT "Watermark" FROM {} WHERE "Entity" = %s').format(state_table), (entity,))
+            row = cursor.fetchone()
     except Exception:
-        logger.exception("An error occurred")
+        logger.exception(f"Could not read the watermark of {entity=}, fetching the full window")
+        return None
+    watermark = row[0] if row else None
+    logger.info(f"Watermark of {entity=}: {watermark}")
+    return watermark
+
+
+def update_watermark(entity: str, timestamps: pd.Series, schema_name: str = "public"):
+    """
+    Stores the latest of the exported timestamps as the watermark of the entity.
+    The watermark never moves back, so that a backfill of older data does not reset it.
+    """
+    watermark = pd.to_datetime(timestamps, utc=True, format="ISO8601").max()
+    if pd.isna(watermark):
+        return
+    state_table = sql.Identifier(schema_name, constants.SYNC_STATE_TABLE)
+    try:
+        with connection() as conn, conn.cursor() as cursor:
+            _ensure_sync_state_table(cursor, state_table)
+            cursor.execute(
+                sql.SQL(
+                    'INSERT INTO {} AS state ("Entity", "Watermark") VALUES (%s, %s) ON CONFLICT ("Entity") DO UPDATE '
+                    'SET "Watermark" = GREATEST(state."Watermark", EXCLUDED."Watermark"), "UpdatedAt" = now()'
+                ).format(state_table),
+                (entity, watermark.to_pydatetime()),
+            )
+    except Exception:
+        # not fatal, the next run just fetches a larger window
+        logger.exception(f"Could not update the watermark of {entity=}")
+        return
+    logger.info(f"Updated the watermark of {entity=} to {watermark}")
+
+
+@functools.cache
+def _ensure_observation_sync_table(schema_name: str) -> sql.Identifier:
+    """
+    Creates (or upgrades) the observation sync table once per process, in a short transaction of its own:
+    the DDL locks the whole table, which must not last for the transaction of an export. Returns the table.
+    """
+    sync_table = sql.Identifier(schema_name, constants.OBSERVATION_SYNC_TABLE)
+    with connection(own=True) as conn, conn.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                'CREATE TABLE IF NOT EXISTS {} ("TraceId" text PRIMARY KEY, "Marker" text, "ObservationCount" integer, '
+                '"PendingMarker" text, "PendingObservationCount" integer, "PendingRunId" text, '
+                '"UpdatedAt" timestamptz NOT NULL DEFAULT now())'
+            ).format(sync_table)
+        )
+        # added after the first version of the table
+        cursor.execute(sql.SQL('ALTER TABLE {} ADD COLUMN IF NOT EXISTS "PendingRunId" text').format(sync_table))
+    return sync_table
+
+
+def get_run_id(**kwargs) -> str | None:
+    """
+    Returns the id of the pipeline run in kwargs, shared by its loader and exporter blocks: its execution date.
+    None without an execution date (local runs).
+    """
+    execution_date = kwargs.get("execution_date")
+    return None if execution_date is None else execution_date.isoformat()
+
+
+def get_observation_sync(trace_ids: list[str], schema_name: str = "public") -> dict[str, tuple[str, int]]:
+    """
+    Returns the (marker, observation count) of the given traces whose observations were exported,
+    or nothing if the sync table cannot be read (then the observations of all the traces are fetched).
+    Read on a connection of its own, so that a failure never aborts the transaction of an export in progress.
+    """
+    try:
+        sync_table = _ensure_observation_sync_table(schema_name)
+        with connection(own=True) as conn, conn.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    'SELECT "TraceId", "Marker", "ObservationCount" FROM {} '
+                    'WHERE "TraceId" = ANY(%s) AND "Marker" IS NOT NULL'
+                ).format(sync_table),
+                (trace_ids,),
+            )
+            rows = cursor.fetchall()
+    except Exception:
+        logger.exception("Could not read the observation sync state, fetching the observations of all the traces")
+        return {}
+    return {trace_id: (marker, observation_count) for trace_id, marker, observation_count in rows}
+
+
+def stage_observation_sync(
+    fetched: dict[str, tuple[str, int]], run_id: str | None, schema_name: str = "public"
+) -> None:
+    """
+    Records the (marker, observation count) of the traces whose observations were fetched by the run as pending,
+    commit_observation_sync makes them the current ones once the run exported the observations.
+    The pending markers of a previous run (whose export failed) are discarded.
+    """
+    try:
+        sync_table = _ensure_observation_sync_table(schema_name)
+        with connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    'UPDATE {} SET "PendingMarker" = NULL, "PendingObservationCount" = NULL, "PendingRunId" = NULL '
+                    'WHERE "PendingMarker" IS NOT NULL'
+                ).format(sync_table)
+            )
+            if fetched:
+                execute_values(
+                    cursor,
+                    sql.SQL(
+                        'INSERT INTO {} ("TraceId", "PendingMarker", "PendingObservationCount", "PendingRunId") VALUES %s '
+                        'ON CONFLICT ("TraceId") DO UPDATE SET "PendingMarker" = EXCLUDED."PendingMarker", '
+                        '"PendingObservationCount" = EXCLUDED."PendingObservationCount", '
+                        '"PendingRunId" = EXCLUDED."PendingRunId"'
+                    )
+                    .format(sync_table)
+                    .as_string(conn),
+                    [
+                        (trace_id, marker, observation_count, run_id)
+                        for trace_id, (marker, observation_count) in fetched.items()
+                    ],
+                    page_size=constants.BATCH_SIZE,
+                )
+    except Exception:
+        # not fatal, the observations of these traces are just fetched again by the next run
+        logger.exception("Could not record the fetched traces in the observation sync state")
+        return
+    logger.info(f"Recorded {len(fetched)} fetched traces as pending in the observation sync state")
+
+
+def commit_observation_sync(run_id: str, schema_name: str = "public") -> None:
+    """
+    Makes the pending markers staged by the run (see stage_observation_sync) the current ones, after the run
+    exported the observations, and removes the traces that were not checked for constants.OBSERVATION_SYNC_RETENTION.
+    Only the markers of the run are committed, so that an empty or failed later run never commits the markers
+    of observations that were not exported.
+    """
+    try:
+        sync_table = _ensure_observation_sync_table(schema_name)
+        with connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    'UPDATE {} SET "Marker" = "PendingMarker", "ObservationCount" = "PendingObservationCount", '
+                    '"PendingMarker" = NULL, "PendingObservationCount" = NULL, "PendingRunId" = NULL, '
+                    '"UpdatedAt" = now() WHERE "PendingMarker" IS NOT NULL AND "PendingRunId" = %s'
+                ).format(sync_table),
+                (run_id,),
+            )
+            committed_count = cursor.rowcount
+            cursor.execute(
+                sql.SQL('DELETE FROM {} WHERE "UpdatedAt" < now() - %s').format(sync_table),
+                (constants.OBSERVATION_SYNC_RETENTION,),
+            )
+    except Exception:
+        logger.exception("Could not commit the observation sync state")
+        return
+    logger.info(f"Committed {committed_count} traces in the observation sync state")
+
+
+def _ensure_backfill_checkpoints_table(cursor, checkpoints_table: sql.Identifier) -> None:
+    cursor.execute(
+        sql.SQL(
+            'CREATE TABLE IF NOT EXISTS {} ("Entity" text NOT NULL, "ShardStart" timestamptz NOT NULL, '
+            '"ShardEnd" timestamptz NOT NULL, "Rows" bigint NOT NULL, "CompletedAt" timestamptz NOT NULL DEFAULT now(), '
+            'PRIMARY KEY ("Entity", "ShardStart", "ShardEnd"))'
+        ).format(checkpoints_table)
+    )
+
+
+def get_completed_shards(entity: str, schema_name: str = "public") -> set[tuple[str, str]]:
+    """
+    Returns the (start, end) of the backfill shards of the entity that were completed, formatted like the shards.
+    """
+    checkpoints_table = sql.Identifier(schema_name, constants.BACKFILL_CHECKPOINTS_TABLE)
+    with connection() as conn, conn.cursor() as cursor:
+        _ensure_backfill_checkpoints_table(cursor, checkpoints_table)
+        cursor.execute(
+            sql.SQL(
+                """SELECT to_char("ShardStart" AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"'), """
+                """to_char("ShardEnd" AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') FROM {} WHERE "Entity" = %s"""
+            ).format(checkpoints_table),
+            (entity,),
+        )
+        return set(cursor.fetchall())
+
+
+def mark_shard_completed(entity: str, shard_start: str, shard_end: str, rows: int, schema_name: str = "public"):
+    checkpoints_table = sql.Identifier(schema_name, constants.BACKFILL_CHECKPOINTS_TABLE)
+    with connection() as conn, conn.cursor() as cursor:
+        _ensure_backfill_checkpoints_table(cursor, checkpoints_table)
+        cursor.execute(
+            sql.SQL(
+                'INSERT INTO {} ("Entity", "ShardStart", "ShardEnd", "Rows") VALUES (%s, %s, %s, %s) '
+                'ON CONFLICT ("Entity", "ShardStart", "ShardEnd") DO UPDATE SET "Rows" = EXCLUDED."Rows", '
+                '"CompletedAt" = now()'
+            ).format(checkpoints_table),
+            (entity, shard_start, shard_end, rows),
+        )
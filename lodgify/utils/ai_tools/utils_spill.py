@@ -0,0 +1,52 @@
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import Any
+
+from lodgify.utils.ai_tools import constants, utils_files
+from lodgify.utils.ai_tools.logger import logger
+
+
+def _window_dir(path: str, end_date: str | None) -> Path:
+    return Path(constants.SPILL_DIR) / path / f"until_{end_date}"
+
+
+def get_spill_dir(path: str, end_date: str | None, params: dict[str, Any]) -> Path:
+    """
+    Returns the directory with the spilled pages of a paginated fetch, keyed by the path and the query parameters
+    (window, filters and limit), so that a retried block run with the same window finds the pages of the failed one.
+    The directories are grouped by the end of the window, which the exporter knows, see clear_spill.
+    """
+    key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    spill_dir = _window_dir(path, end_date) / key
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    spilled_pages = len(list(spill_dir.glob("page_*.json")))
+    if spilled_pages:
+        logger.info(f"Resuming {path=} with {spilled_pages} pages spilled by a previous attempt in {spill_dir}")
+    return spill_dir
+
+
+def read_page(spill_dir: Path, page: int) -> bytes | None:
+    try:
+        return (spill_dir / f"page_{page:06d}.json").read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def write_page(spill_dir: Path, page: int, content: bytes):
+    # created again if an overlapping run cleared the spill of the same window meanwhile
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    with utils_files.atomic_path(spill_dir / f"page_{page:06d}.json") as tmp_file:
+        tmp_file.write_bytes(content)
+
+
+def clear_spill(path: str, end_date: str | None):
+    """
+    Removes the spilled pages of the path for the window ending at 'end_date', to be called once its data was
+    exported successfully. The spills of the other windows (eg of an overlapping backfill) are kept.
+    """
+    spill_dir = _window_dir(path, end_date)
+    if spill_dir.is_dir():
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        logger.debug(f"Removed the spilled pages of {path=} until {end_date}")
@@ -0,0 +1,49 @@
+"""
+The markers of the observations loader, which skips the traces whose observations did not change since the last run.
+
+    MAGE_REPO_PATH=lodgify python -m unittest discover tests
+"""
+
+import unittest
+from unittest import mock
+
+from benchmarks.fake_langfuse import FakeConfig, FakeLangfuse
+from lodgify.data_loaders import ai_tools_fetch_observations
+from lodgify.utils.ai_tools import schemas
+
+
+def find_changed_traces(synced_traces: list[dict], traces: list[dict]) -> dict[str, str]:
+    """
+    Returns the changed markers of 'traces' after a run that exported the observations of 'synced_traces'.
+    """
+    synced = {}
+    for run_traces in (synced_traces, traces):
+        with mock.patch.object(ai_tools_fetch_observations.utils_postgres, "get_observation_sync", return_value=synced):
+            changed_markers, _ = ai_tools_fetch_observations.find_changed_traces(
+                schemas.build_frame(run_traces, schemas.TRACE_COLUMNS)
+            )
+        synced = {trace_id: (marker, 5) for trace_id, marker in changed_markers.items()}
+    return changed_markers
+
+
+class FindChangedTracesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        fake = FakeLangfuse(FakeConfig(traces=3, payload_size=50))
+        self.traces = [fake.trace(index) for index in range(3)]
+
+    def test_unchanged_traces_are_skipped(self) -> None:
+        self.assertEqual(find_changed_traces(self.traces, self.traces), {})
+
+    def test_observation_added_without_cost_is_a_change(self) -> None:
+        traces = [dict(trace) for trace in self.traces]
+        traces[1]["observations"] = [*traces[1]["observations"], "observation-event-without-cost"]
+        self.assertEqual(list(find_changed_traces(self.traces, traces)), [traces[1]["id"]])
+
+    def test_observation_order_is_not_a_change(self) -> None:
+        traces = [dict(trace) for trace in self.traces]
+        traces[2]["observations"] = traces[2]["observations"][::-1]
+        self.assertEqual(find_changed_traces(self.traces, traces), {})
+
+
+if __name__ == "__main__":
+    unittest.main()